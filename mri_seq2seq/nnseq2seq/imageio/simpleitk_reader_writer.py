@@ -1,3 +1,4 @@
+from concurrent.futures import ThreadPoolExecutor
 from typing import Tuple, Union, List
 import numpy as np
 from nnseq2seq.imageio.base_reader_writer import BaseReaderWriter
@@ -10,6 +11,8 @@ class SimpleITKIO(BaseReaderWriter):
         '.nrrd',
         '.mha'
     ]
+    # upper bound for the number of files of one case that are read at the same time
+    max_io_threads = 4
 
     def read_images(self, image_fnames: Union[List[str], Tuple[str, ...]]) -> Tuple[np.ndarray, dict]:
         images = []
@@ -18,12 +21,15 @@ class SimpleITKIO(BaseReaderWriter):
         directions = []
 
         spacings_for_nnseq2seq = []
-        for f in image_fnames:
-            itk_image = sitk.ReadImage(f)
+        # the channel files of a case are read concurrently, SimpleITK releases the GIL while reading and decompressing
+        with ThreadPoolExecutor(max_workers=max(1, min(len(image_fnames), self.max_io_threads))) as executor:
+            itk_images = list(executor.map(sitk.ReadImage, image_fnames))
+        for f, itk_image in zip(image_fnames, itk_images):
             spacings.append(itk_image.GetSpacing())
             origins.append(itk_image.GetOrigin())
             directions.append(itk_image.GetDirection())
-            npy_image = sitk.GetArrayFromImage(itk_image)
+            # view of the itk buffer instead of a copy. itk_images keeps the buffers alive until they are stacked below
+            npy_image = sitk.GetArrayViewFromImage(itk_image)
             if npy_image.ndim == 2:
                 # 2d
                 npy_image = npy_image[None, None]
@@ -83,6 +89,7 @@ class SimpleITKIO(BaseReaderWriter):
             raise RuntimeError()
 
         stacked_images = np.vstack(images)
+        del images, itk_images
         dict = {
             'sitk_stuff': {
                 # this saves the sitk geometry information. This part is NOT used by nnSeq2Seq!
@@ -94,7 +101,7 @@ class SimpleITKIO(BaseReaderWriter):
             # are returned x,y,z but spacing is returned z,y,x. Duh.
             'spacing': spacings_for_nnseq2seq[0]
         }
-        return stacked_images.astype(np.float32), dict
+        return stacked_images.astype(np.float32, copy=False), dict
 
     def read_seg(self, seg_fname: str) -> Tuple[np.ndarray, dict]:
         return self.read_images((seg_fname, ))
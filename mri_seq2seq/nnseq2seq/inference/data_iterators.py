@@ -114,7 +114,8 @@ def preprocessing_iterator_fromfiles(list_of_lists: List[List[str]],
             sleep(0.01)
             continue
         if pin_memory:
-            [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
+            # pin_memory is not in place, the pinned copies have to replace the pageable tensors
+            item = {k: v.pin_memory() if isinstance(v, torch.Tensor) else v for k, v in item.items()}
         yield item
     [p.join() for p in processes]
 
@@ -313,6 +314,7 @@ def preprocessing_iterator_fromnpy(list_of_images: List[np.ndarray],
             sleep(0.01)
             continue
         if pin_memory:
-            [i.pin_memory() for i in item.values() if isinstance(i, torch.Tensor)]
+            # pin_memory is not in place, the pinned copies have to replace the pageable tensors
+            item = {k: v.pin_memory() if isinstance(v, torch.Tensor) else v for k, v in item.items()}
         yield item
     [p.join() for p in processes]
\ No newline at end of file
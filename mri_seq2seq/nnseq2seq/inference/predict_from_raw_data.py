@@ -2,18 +2,23 @@ import inspect
 import itertools
 import multiprocessing
 import os
+import queue
+import signal
+import stat
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import Listener, Client
+from multiprocessing import AuthenticationError
 from copy import deepcopy
-from time import sleep
 from typing import Tuple, Union, List, Optional
 
 import numpy as np
 import pandas as pd
 import torch
-import torch.nn.functional as F
 from acvl_utils.cropping_and_padding.padding import pad_nd_image
 from batchgenerators.dataloading.multi_threaded_augmenter import MultiThreadedAugmenter
-from batchgenerators.utilities.file_and_folder_operations import load_json, join, isfile, maybe_mkdir_p, isdir, subdirs, \
-    save_json
+from batchgenerators.utilities.file_and_folder_operations import load_json, join, isfile, maybe_mkdir_p, isdir, save_json
 from torch import nn
 from torch._dynamo import OptimizedModule
 from torch.nn.parallel import DistributedDataParallel
@@ -30,7 +35,7 @@ from nnseq2seq.inference.sliding_window_prediction import compute_gaussian, \
     compute_steps_for_sliding_window
 from nnseq2seq.postprocessing.sitk_process import histMatch, linearMatch
 from nnseq2seq.training.loss.metrics import torch_PSNR, np_SSIM, torch_LPIPS
-from nnseq2seq.utilities.file_path_utilities import get_output_folder, check_workers_alive_and_busy
+from nnseq2seq.utilities.file_path_utilities import get_output_folder
 from nnseq2seq.utilities.find_class_by_name import recursive_find_python_class
 from nnseq2seq.utilities.helpers import empty_cache, dummy_context
 from nnseq2seq.utilities.json_export import recursive_fix_for_json_export
@@ -39,6 +44,95 @@ from nnseq2seq.utilities.plans_handling.plans_handler import PlansManager, Confi
 from nnseq2seq.utilities.utils import create_lists_from_splitted_dataset_folder
 
 
+class _Prefetcher(object):
+    """
+    Pulls items from data_iterator in a background thread and keeps up to max_prefetch of them in a queue, so that
+    loading (and pinning) the next cases overlaps with the prediction of the current one. Use it as a context manager:
+    leaving the with block stops the thread, even if the prediction loop raised, and removes the memory mapped files
+    of the cases that were not finished
+    """
+    _done = object()
+
+    def __init__(self, data_iterator, pin_memory: bool = False, max_prefetch: int = 2):
+        self.data_iterator = data_iterator
+        self.pin_memory = pin_memory
+        self.queue = queue.Queue(maxsize=max_prefetch)
+        self._stop = threading.Event()
+        # the item that was handed out last, its file is removed once the next one is requested or on close
+        self._current = None
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        # a plain put would block forever once nobody consumes the queue anymore
+        while not self._stop.is_set():
+            try:
+                self.queue.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    @staticmethod
+    def _remove_file(item):
+        if isinstance(item, dict) and item.get('delfile') is not None:
+            os.remove(item.pop('delfile'))
+
+    def _run(self):
+        try:
+            for item in self.data_iterator:
+                data = item['data']
+                if isinstance(data, str):
+                    # map the file instead of reading it into RAM first. Copy-on-write keeps the tensor writable
+                    # without touching the file. The file can only go once the tensor no longer needs it: right away
+                    # if pinning made a copy, otherwise after the case was predicted (see 'delfile')
+                    delfile = data
+                    data = torch.from_numpy(np.load(data, mmap_mode='c'))
+                    if self.pin_memory:
+                        data = data.pin_memory()
+                        os.remove(delfile)
+                    else:
+                        item['delfile'] = delfile
+                elif self.pin_memory:
+                    data = data.pin_memory()
+                item['data'] = data
+                if not self._put(item):
+                    self._remove_file(item)
+                    return
+        except Exception as e:
+            self._put(e)
+            return
+        self._put(self._done)
+
+    def __iter__(self):
+        while True:
+            item = self.queue.get()
+            # the previous case is done, its mapped file is not needed anymore
+            self._remove_file(self._current)
+            self._current = None
+            if item is self._done:
+                return
+            if isinstance(item, Exception):
+                raise item
+            self._current = item
+            yield item
+
+    def close(self):
+        self._stop.set()
+        # the thread notices the stop within a put timeout, or once the case it is currently loading is done
+        self.thread.join()
+        self._remove_file(self._current)
+        self._current = None
+        while not self.queue.empty():
+            self._remove_file(self.queue.get())
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 class nnSeq2SeqPredictor(object):
     def __init__(self,
                  tile_step_size: float = 0.5,
@@ -48,7 +142,16 @@ class nnSeq2SeqPredictor(object):
                  device: torch.device = torch.device('cuda'),
                  verbose: bool = False,
                  verbose_preprocessing: bool = False,
-                 allow_tqdm: bool = True):
+                 allow_tqdm: bool = True,
+                 max_src_batch: int = 1,
+                 tile_batch_size: int = 1,
+                 segmentation_running_argmax: bool = False,
+                 encoder_flip_equivariant: bool = False,
+                 precision: str = 'fp16',
+                 channels_last: bool = True,
+                 fold_ensemble: str = 'avg_predictions',
+                 keep_on_device: bool = False,
+                 max_views_per_forward: int = 1):
         self.verbose = verbose
         self.verbose_preprocessing = verbose_preprocessing
         self.allow_tqdm = allow_tqdm
@@ -59,6 +162,41 @@ class nnSeq2SeqPredictor(object):
         self.tile_step_size = tile_step_size
         self.use_gaussian = use_gaussian
         self.use_mirroring = use_mirroring
+        # number of source images that are pushed through the sliding window together. Every source multiplies the
+        # batch of the forward passes, so this is opt-in
+        assert max_src_batch >= 1, f'max_src_batch must be at least 1. Got: {max_src_batch}'
+        self.max_src_batch = max_src_batch
+        # number of sliding window tiles that are predicted in one forward pass. Sources and mirrored views share the
+        # batch axis as well, so the effective batch size is tile_batch_size * sources * max_views_per_forward
+        assert tile_batch_size >= 1, f'tile_batch_size must be at least 1. Got: {tile_batch_size}'
+        self.tile_batch_size = tile_batch_size
+        # number of mirrored views (mirror TTA, up to 8 in 3d) that are stacked into one forward pass. 1 needs as much
+        # memory as predicting without mirroring. Halved for the current image if the sliding window runs out of device
+        # memory
+        assert max_views_per_forward >= 1, f'max_views_per_forward must be at least 1. Got: {max_views_per_forward}'
+        self.max_views_per_forward = max_views_per_forward
+        # aggregate segmentation masks as running argmax over the weighted tile logits instead of summing them. Needs a
+        # fraction of the memory, but where tiles overlap the result can differ from the argmax of the summed logits
+        self.segmentation_running_argmax = segmentation_running_argmax
+        # treat the image encoder as equivariant to mirroring, so that mirror TTA of the multi-to-one translation only
+        # runs the encoder once per tile. Learned convolution kernels are not symmetric, so this is an approximation
+        self.encoder_flip_equivariant = encoder_flip_equivariant
+        assert precision in ('bf16', 'fp16', 'fp32'), f'precision must be bf16, fp16 or fp32. Got: {precision}'
+        # autocast dtype of the network forward. fp16 is the default, bf16 trades mantissa bits for range and is opt-in.
+        # Mirror merging and aggregation are done in _get_aggregation_dtype() either way
+        self.precision = precision
+        # run the image encoder in channels last memory format on cuda. Its convolutions and channels first layer
+        # norms are the bulk of the encoder cost and cudnn picks faster (tensor core) kernels for NDHWC under autocast
+        self.channels_last = channels_last and device.type == 'cuda'
+        # whether the encoder of the current network was converted. Only networks built from a model folder are, the
+        # ones handed to manual_initialization belong to the caller (the trainer) and keep their memory format
+        self._encoder_channels_last = False
+        assert fold_ensemble in ('avg_predictions', 'avg_weights'), \
+            f'fold_ensemble must be avg_predictions or avg_weights. Got: {fold_ensemble}'
+        # avg_predictions runs every fold and averages their outputs. avg_weights averages the weights of the folds
+        # into a single network (model soup) that is run once. Only meaningful if the folds were fine-tuned from the
+        # same pretrained weights, independently initialized folds do not average into a working network
+        self.fold_ensemble = fold_ensemble
         if device.type == 'cuda':
             # device = torch.device(type='cuda', index=0)  # set the desired GPU with CUDA_VISIBLE_DEVICES!
             pass
@@ -67,6 +205,18 @@ class nnSeq2SeqPredictor(object):
             perform_everything_on_device = False
         self.device = device
         self.perform_everything_on_device = perform_everything_on_device
+        # keep the case, the fold accumulators and the predictions on the device until they are exported. Saves the
+        # host round trips but needs the memory of all outputs of a target on top of the sliding window buffers, so
+        # this is opt-in. Without it the outputs are moved to the CPU after every fold
+        self.keep_on_device = keep_on_device and perform_everything_on_device
+        # one entry per parameter set, see _get_task_specific_contribution
+        self._task_specific_contribution_cache = {}
+        self._gaussian_cache = {}
+        # least recently used first. Every distinct image shape adds an entry, so it is bounded for long running
+        # servers, see _internal_get_sliding_window_slicers
+        self._sliding_window_slicers_cache = {}
+        self._sliding_window_slicers_cache_size = 16
+        self._compiled_multi2one_forward = None
 
     def initialize_from_trained_model_folder(self, model_training_output_dir: str,
                                              use_folds: Union[Tuple[Union[int, str]], None],
@@ -84,18 +234,23 @@ class nnSeq2SeqPredictor(object):
         if isinstance(use_folds, str):
             use_folds = [use_folds]
 
-        parameters = []
-        for i, f in enumerate(use_folds):
-            f = int(f) if f != 'all' else f
-            checkpoint = torch.load(join(model_training_output_dir, f'fold_{f}', checkpoint_name),
-                                    map_location=torch.device('cpu'))
-            if i == 0:
-                trainer_name = checkpoint['trainer_name']
-                configuration_name = checkpoint['init_args']['configuration']
-                inference_allowed_mirroring_axes = checkpoint['inference_allowed_mirroring_axes'] if \
-                    'inference_allowed_mirroring_axes' in checkpoint.keys() else None
-
-            parameters.append(checkpoint['network_weights'])
+        # loading the checkpoints is mostly disk bound, so the folds are read concurrently. Where torch supports it
+        # (>=2.1) the checkpoints are memory mapped: only the network weights are needed here, so the optimizer state
+        # that makes up most of the file is never read from disk
+        use_folds = [int(f) if f != 'all' else f for f in use_folds]
+        load_kwargs = {'mmap': True} if 'mmap' in inspect.signature(torch.load).parameters.keys() else {}
+        with ThreadPoolExecutor(max_workers=max(1, len(use_folds))) as executor:
+            checkpoints = list(executor.map(
+                lambda f: torch.load(join(model_training_output_dir, f'fold_{f}', checkpoint_name),
+                                     map_location=torch.device('cpu'), **load_kwargs), use_folds))
+        trainer_name = checkpoints[0]['trainer_name']
+        configuration_name = checkpoints[0]['init_args']['configuration']
+        inference_allowed_mirroring_axes = checkpoints[0]['inference_allowed_mirroring_axes'] if \
+            'inference_allowed_mirroring_axes' in checkpoints[0].keys() else None
+        parameters = [checkpoint['network_weights'] for checkpoint in checkpoints]
+        del checkpoints
+        if self.fold_ensemble == 'avg_weights' and len(parameters) > 1:
+            parameters = [self._average_fold_parameters(parameters)]
 
         configuration_manager = plans_manager.get_configuration(configuration_name)
         # restore network
@@ -116,14 +271,31 @@ class nnSeq2SeqPredictor(object):
         self.configuration_manager = configuration_manager
         self.list_of_parameters = parameters
         self.network = network
+        self._task_specific_contribution_cache.clear()
         self.dataset_json = dataset_json
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        # converted once here, load_state_dict copies the fold weights into the converted parameters
+        self._encoder_channels_last = self.channels_last
+        if self._encoder_channels_last:
+            self.network.image_encoder.to(memory_format=self._get_encoder_memory_format())
         if ('nnSeq2Seq_compile' in os.environ.keys()) and (os.environ['nnSeq2Seq_compile'].lower() in ('true', '1', 't')) \
                 and not isinstance(self.network, OptimizedModule):
             print('Using torch.compile')
-            self.network = torch.compile(self.network)
+            self.network = torch.compile(self.network, mode='reduce-overhead', fullgraph=False, dynamic=False)
+            self._compile_multi2one_forward()
+
+    @staticmethod
+    def _average_fold_parameters(parameters: List[dict]) -> dict:
+        # floating point weights are averaged, everything else (counters, index buffers) is taken from the first fold
+        averaged = {}
+        for k, v in parameters[0].items():
+            if torch.is_floating_point(v):
+                averaged[k] = torch.stack([p[k].float() for p in parameters]).mean(0).to(v.dtype)
+            else:
+                averaged[k] = v
+        return averaged
 
     def manual_initialization(self, network: nn.Module, plans_manager: PlansManager,
                               configuration_manager: ConfigurationManager, parameters: Optional[List[dict]],
@@ -136,10 +308,12 @@ class nnSeq2SeqPredictor(object):
         self.configuration_manager = configuration_manager
         self.list_of_parameters = parameters
         self.network = network
+        self._task_specific_contribution_cache.clear()
         self.dataset_json = dataset_json
         self.trainer_name = trainer_name
         self.allowed_mirroring_axes = inference_allowed_mirroring_axes
         self.label_manager = plans_manager.get_label_manager(dataset_json)
+        self._encoder_channels_last = False
         allow_compile = True
         allow_compile = allow_compile and ('nnSeq2Seq_compile' in os.environ.keys()) and (
                     os.environ['nnSeq2Seq_compile'].lower() in ('true', '1', 't'))
@@ -148,18 +322,73 @@ class nnSeq2SeqPredictor(object):
             allow_compile = allow_compile and isinstance(self.network.module, OptimizedModule)
         if allow_compile:
             print('Using torch.compile')
-            self.network = torch.compile(self.network)
+            self.network = torch.compile(self.network, mode='reduce-overhead', fullgraph=False, dynamic=False)
+            self._compile_multi2one_forward()
+
+    def _compile_multi2one_forward(self):
+        # the multi-to-one translation calls the sub-networks directly, which bypasses the compiled network. Compile
+        # that path on its own
+        self._compiled_multi2one_forward = torch.compile(self._multi2one_forward, mode='reduce-overhead',
+                                                         fullgraph=False, dynamic=False)
 
     @staticmethod
     def auto_detect_available_folds(model_training_output_dir, checkpoint_name):
         print('use_folds is None, attempting to auto detect available folds')
-        fold_folders = subdirs(model_training_output_dir, prefix='fold_', join=False)
-        fold_folders = [i for i in fold_folders if i != 'fold_all']
-        fold_folders = [i for i in fold_folders if isfile(join(model_training_output_dir, i, checkpoint_name))]
-        use_folds = [int(i.split('_')[-1]) for i in fold_folders]
+        # a single directory listing tells us which entries are fold folders, only those get a stat for the checkpoint
+        with os.scandir(model_training_output_dir) as it:
+            fold_folders = [e.name for e in it if e.is_dir() and e.name.startswith('fold_') and e.name != 'fold_all'
+                            and isfile(join(model_training_output_dir, e.name, checkpoint_name))]
+        use_folds = sorted([int(i.split('_')[-1]) for i in fold_folders])
         print(f'found the following folds: {use_folds}')
         return use_folds
 
+    def _load_network_parameters(self, params: dict):
+        # messing with state dict names...
+        if not isinstance(self.network, OptimizedModule):
+            self.network.load_state_dict(params)
+        else:
+            self.network._orig_mod.load_state_dict(params)
+
+    def _get_task_specific_contribution(self):
+        """
+        Evaluates the task-specific contribution of every channel for all translation targets plus the segmentation
+        task in a single batched call. It is evaluated with the weights of the first fold (the averaged weights with
+        fold_ensemble='avg_weights'), not with whichever weights happen to be loaded, and cached per parameter set.
+        """
+        params = self.list_of_parameters[0] if self.list_of_parameters else None
+        # list_of_parameters keeps the parameter sets alive until the cache is cleared by a (re)initialization, so their
+        # ids cannot be reused while they are keys. Without parameters (manual_initialization) the network is used as is
+        key = id(params) if params is not None else None
+        if key not in self._task_specific_contribution_cache:
+            if params is not None:
+                self._load_network_parameters(params)
+            num_channel = self.network.tsf.num_channel
+            eye = torch.eye(num_channel, dtype=torch.float32)
+            tgt_codes = torch.cat([1 - eye, eye, torch.zeros((num_channel, 1))], dim=1)
+            seg_code = torch.cat([torch.ones((1, num_channel)), torch.zeros((1, num_channel)), torch.ones((1, 1))],
+                                 dim=1)
+            codes = torch.cat([tgt_codes, seg_code], dim=0).to(next(self.network.tsf.parameters()).device)
+            with torch.inference_mode():
+                w = self.network.tsf.infer_contribution(codes)
+            w = w.reshape(num_channel + 1, num_channel).cpu().numpy().tolist()
+            ts_w = [[tgt_id] + w[tgt_id] for tgt_id in range(num_channel)]
+            ts_w.append(['seg'] + w[num_channel])
+            self._task_specific_contribution_cache[key] = ts_w
+        return self._task_specific_contribution_cache[key]
+
+    def _move_to_cpu_for_export(self, *tensors: torch.Tensor) -> List[torch.Tensor]:
+        """
+        Only queues the device to host copies, the device keeps working on the next prediction while they run. The
+        returned tensors must not be read before _wait_for_export_copies
+        """
+        return [i.to('cpu', non_blocking=True) for i in tensors]
+
+    def _wait_for_export_copies(self):
+        # all copies queued by _move_to_cpu_for_export are done once the device has caught up. Call this right before
+        # results are handed to the export workers, so that this is the only point where the host waits
+        if self.device.type == 'cuda':
+            torch.cuda.synchronize(self.device)
+
     def _manage_input_and_output_lists(self, list_of_lists_or_source_folder: Union[str, List[List[str]]],
                                        output_folder_or_list_of_truncated_output_files: Union[None, str, List[str]],
                                        folder_with_segs_from_prev_stage: str = None,
@@ -167,12 +396,13 @@ class nnSeq2SeqPredictor(object):
                                        part_id: int = 0,
                                        num_parts: int = 1,
                                        save_probabilities: bool = False):
+        file_ending = self.dataset_json['file_ending']
         if isinstance(list_of_lists_or_source_folder, str):
             list_of_lists_or_source_folder = create_lists_from_splitted_dataset_folder(list_of_lists_or_source_folder,
-                                                                                       self.dataset_json['file_ending'])
+                                                                                       file_ending)
         print(f'There are {len(list_of_lists_or_source_folder)} cases in the source folder')
         list_of_lists_or_source_folder = list_of_lists_or_source_folder[part_id::num_parts]
-        caseids = [os.path.basename(i[0])[:-(len(self.dataset_json['file_ending']) + 5)] for i in
+        caseids = [os.path.basename(i[0])[:-(len(file_ending) + 5)] for i in
                    list_of_lists_or_source_folder]
         print(
             f'I am process {part_id} out of {num_parts} (max process ID is {num_parts - 1}, we start counting with 0!)')
@@ -183,13 +413,22 @@ class nnSeq2SeqPredictor(object):
         else:
             output_filename_truncated = output_folder_or_list_of_truncated_output_files
 
-        seg_from_prev_stage_files = [join(folder_with_segs_from_prev_stage, i + self.dataset_json['file_ending']) if
+        seg_from_prev_stage_files = [join(folder_with_segs_from_prev_stage, i + file_ending) if
                                      folder_with_segs_from_prev_stage is not None else None for i in caseids]
         # remove already predicted files form the lists
         if not overwrite and output_filename_truncated is not None:
-            tmp = [isfile(i + self.dataset_json['file_ending']) for i in output_filename_truncated]
+            # list every output folder once instead of stat-ing each expected file
+            existing_files = {}
+            for d in set([os.path.dirname(i) for i in output_filename_truncated]):
+                existing_files[d] = set()
+                if isdir(d or '.'):
+                    with os.scandir(d or '.') as it:
+                        existing_files[d] = set([e.name for e in it if e.is_file()])
+            tmp = [os.path.basename(i) + file_ending in existing_files[os.path.dirname(i)]
+                   for i in output_filename_truncated]
             if save_probabilities:
-                tmp2 = [isfile(i + '.npz') for i in output_filename_truncated]
+                tmp2 = [os.path.basename(i) + '.npz' in existing_files[os.path.dirname(i)]
+                        for i in output_filename_truncated]
                 tmp = [i and j for i, j in zip(tmp, tmp2)]
             not_existing_indices = [i for i, j in enumerate(tmp) if not j]
 
@@ -209,10 +448,14 @@ class nnSeq2SeqPredictor(object):
                            num_processes_segmentation_export: int = 8,
                            folder_with_segs_from_prev_stage: str = None,
                            num_parts: int = 1,
-                           part_id: int = 0):
+                           part_id: int = 0,
+                           save_latent_space: bool = True):
         """
         This is nnSeq2Seq's default function for making predictions. It works best for batch predictions
         (predicting many images at once).
+
+        save_latent_space=False skips aggregating and exporting the latent space of the one-to-one translations,
+        which is the largest buffer of the sliding window prediction.
         """
         if isinstance(output_folder_or_list_of_truncated_output_files, str):
             output_folder = output_folder_or_list_of_truncated_output_files
@@ -237,16 +480,10 @@ class nnSeq2SeqPredictor(object):
             save_json(self.dataset_json, join(output_folder, 'dataset.json'), sort_keys=False)
             save_json(self.plans_manager.plans, join(output_folder, 'plans.json'), sort_keys=False)
             # save task-specific contribution
-            self.one2one_translate_psnr = [[[] for _ in range(self.network.tsf.num_channel)] for _ in range(self.network.tsf.num_channel)]
-            ts_w = []
-            for tgt_id in range(self.network.tsf.num_channel):
-                tgt_code = torch.from_numpy(np.array([1 if i!=tgt_id else 0 for i in range(self.network.tsf.num_channel)] + [1 if i==tgt_id else 0 for i in range(self.network.tsf.num_channel)]+[0])).unsqueeze(0).to(dtype=torch.float32)
-                w1 = self.network.tsf.infer_contribution(tgt_code)
-                ts_w.append([tgt_id]+w1.squeeze().detach().numpy().tolist())
-            seg_code = torch.from_numpy(np.array([1 for i in range(self.network.tsf.num_channel)] + [0 for i in range(self.network.tsf.num_channel)]+[1])).unsqueeze(0).to(dtype=torch.float32)
-            w2 = self.network.tsf.infer_contribution(seg_code)
-            ts_w.append(['seg']+w2.squeeze().detach().numpy().tolist())
-            df = pd.DataFrame(data=ts_w, columns=['tgt']+['channel_{}'.format(i) for i in range(self.network.tsf.num_channel)])
+            num_channel = self.network.tsf.num_channel
+            self.one2one_translate_psnr = [[[] for _ in range(num_channel)] for _ in range(num_channel)]
+            ts_w = self._get_task_specific_contribution()
+            df = pd.DataFrame(data=ts_w, columns=['tgt']+['channel_{}'.format(i) for i in range(num_channel)])
             df.to_csv(join(output_folder, 'task-specific_sequence_contribution.csv'))
         #######################
 
@@ -271,7 +508,8 @@ class nnSeq2SeqPredictor(object):
                                                                                  output_filename_truncated,
                                                                                  num_processes_preprocessing)
 
-        return self.predict_from_data_iterator(data_iterator, save_probabilities, num_processes_segmentation_export)
+        return self.predict_from_data_iterator(data_iterator, save_probabilities, num_processes_segmentation_export,
+                                               save_latent_space)
 
     def _internal_get_data_iterator_from_lists_of_filenames(self,
                                                             input_list_of_lists: List[List[str]],
@@ -356,20 +594,25 @@ class nnSeq2SeqPredictor(object):
     def predict_from_data_iterator(self,
                                    data_iterator,
                                    save_probabilities: bool = False,
-                                   num_processes_segmentation_export: int = 8):
+                                   num_processes_segmentation_export: int = 8,
+                                   save_latent_space: bool = True):
         """
         each element returned by data_iterator must be a dict with 'data', 'ofile' and 'data_properties' keys!
         If 'ofile' is None, the result will be returned instead of written to a file
+
+        Returns one entry per export job, in the order the jobs were submitted (None for exports written to disk)
         """
-        with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool:
+        with multiprocessing.get_context("spawn").Pool(num_processes_segmentation_export) as export_pool, \
+                _Prefetcher(data_iterator, pin_memory=self.device.type == 'cuda') as prefetcher:
             worker_list = [i for i in export_pool._pool]
+            # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
+            # npy files. Every export job takes a slot that is given back once its batch is done, so at most two jobs
+            # wait in the queue on top of the ones being worked on (or one batch, if a target has more exports)
+            export_queue_size = num_processes_segmentation_export + 2
+            export_semaphore = threading.BoundedSemaphore(export_queue_size)
             r = []
-            for preprocessed in data_iterator:
+            for preprocessed in prefetcher:
                 data = preprocessed['data']
-                if isinstance(data, str):
-                    delfile = data
-                    data = torch.from_numpy(np.load(data))
-                    os.remove(delfile)
 
                 ofile = preprocessed['ofile']
                 if ofile is not None:
@@ -380,113 +623,100 @@ class nnSeq2SeqPredictor(object):
                 print(f'perform_everything_on_device: {self.perform_everything_on_device}')
 
                 properties = preprocessed['data_properties']
-
-                # let's not get into a runaway situation where the GPU predicts so fast that the disk has to b swamped with
-                # npy files
-                proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                while not proceed:
-                    sleep(0.1)
-                    proceed = not check_workers_alive_and_busy(export_pool, worker_list, r, allowed_num_queued=2)
-                
-                for tgt_seq in range(properties['num_channel']):
-                    tgt_code = F.one_hot(torch.from_numpy(np.array([tgt_seq], dtype=np.int64)),
-                        num_classes=properties['num_channel']).to(self.device, dtype=data.dtype, non_blocking=True)
-                    
-                    tsf_prediction, _, _ = self.predict_logits_from_preprocessed_data(data, tgt_code, properties=properties, with_attn=False)
-                    tsf_prediction_finetune, tsf_prediction_mask_finetune, _ = self.predict_logits_from_preprocessed_data(data, tgt_code, properties=properties, with_attn=True)
-                    tsf_prediction_mask_finetune = torch.argmax(tsf_prediction_mask_finetune, dim=0, keepdim=True).cpu()
+                if ofile is not None:
+                    self._ensure_case_dirs(ofile, save_latent_space)
+
+                # target codes and source slices do not change within a case, build them once
+                num_channel = properties['num_channel']
+                available_channel = properties['available_channel']
+                num_src = len(available_channel)
+                tgt_codes = torch.eye(num_channel, dtype=data.dtype, device=self.device)
+                src_data = [data[src_idx:src_idx+1] for src_idx in range(num_src)]
+                # with keep_on_device the predictions and everything derived from them stay on the device until they
+                # are exported, otherwise they come back on the CPU and _move_to_cpu_for_export does nothing
+                keep_on_device = self.keep_on_device
+                data_for_prediction = data.to(self.device, non_blocking=True) if keep_on_device else data
+                # exports of the current target, handed to the workers once the target is done
+                pending_exports = []
+                for tgt_seq in range(num_channel):
+                    tgt_code = tgt_codes[tgt_seq:tgt_seq+1]
+
+                    # the translation without attention is only needed for the task-specific enhanced map. It comes out
+                    # of the same sliding window pass (the fusion module exposes both branches), so the encoder and the
+                    # fusion module are not run a second time for it
+                    tsf_predictions, tsf_prediction_mask_finetune, _ = self.predict_logits_from_preprocessed_data(data_for_prediction, tgt_code, properties=properties, with_attn='both', keep_on_device=keep_on_device, return_latent=False)
+                    tsf_prediction_finetune, tsf_prediction = tsf_predictions[0:1], tsf_predictions[1:2]
+                    tsf_prediction_mask_finetune = self._mask_to_segmentation(tsf_prediction_mask_finetune)
                     tsem = torch.abs(tsf_prediction_finetune-tsf_prediction)
-                    os.makedirs(os.path.join(ofile, 'multi2one_inference'), exist_ok=True)
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits,
-                            ((tsf_prediction_finetune, properties, self.configuration_manager, self.plans_manager,
-                            self.dataset_json, os.path.join(ofile, 'multi2one_inference', 'translate_tgt_{}'.format(tgt_seq)), save_probabilities),)
-                        )
-                    )
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits,
-                            ((tsf_prediction_mask_finetune, properties, self.configuration_manager, self.plans_manager,
-                            self.dataset_json, os.path.join(ofile, 'multi2one_inference', 'segment'), save_probabilities),)
-                        )
-                    )
-                    os.makedirs(os.path.join(ofile, 'explainability_visualization/task-specific_enhanced_map'), exist_ok=True)
-                    r.append(
-                        export_pool.starmap_async(
-                            export_prediction_from_logits,
-                            ((tsem, properties, self.configuration_manager, self.plans_manager,
-                            self.dataset_json, os.path.join(ofile, 'explainability_visualization/task-specific_enhanced_map', 'task-specific_enhanced_map_tgt_{}'.format(tgt_seq)), save_probabilities),)
-                        )
-                    )
-
-                    md = torch.zeros_like(data[0:1])
-                    for src_idx, src_seq in enumerate(properties['available_channel']):
-                        prediction, prediction_mask, prediction_latent = self.predict_logits_from_preprocessed_data(data[src_idx:src_idx+1], tgt_code)
-                        prediction_mask = torch.argmax(prediction_mask, dim=0, keepdim=True).cpu()
-                        prediction_latent = F.interpolate(prediction_latent.to(dtype=torch.float32).unsqueeze(0), scale_factor=0.25)[0].cpu()
-
-                        if tgt_seq in properties['available_channel']:
-                            tgt_idx = properties['available_channel'].index(tgt_seq)
-                            hm_prediction = linearMatch(prediction, data[tgt_idx:tgt_idx+1])
+                    tsf_prediction_finetune, tsf_prediction_mask_finetune, tsem = self._move_to_cpu_for_export(
+                        tsf_prediction_finetune, tsf_prediction_mask_finetune, tsem)
+                    pending_exports.append((tsf_prediction_finetune, properties, self.configuration_manager, self.plans_manager,
+                        self.dataset_json, os.path.join(ofile, 'multi2one_inference', 'translate_tgt_{}'.format(tgt_seq)), save_probabilities))
+                    pending_exports.append((tsf_prediction_mask_finetune, properties, self.configuration_manager, self.plans_manager,
+                        self.dataset_json, os.path.join(ofile, 'multi2one_inference', 'segment'), save_probabilities))
+                    pending_exports.append((tsem, properties, self.configuration_manager, self.plans_manager,
+                        self.dataset_json, os.path.join(ofile, 'explainability_visualization/task-specific_enhanced_map', 'task-specific_enhanced_map_tgt_{}'.format(tgt_seq)), save_probabilities))
+
+                    md = torch.zeros_like(data_for_prediction[0:1])
+                    src_predictions = []
+                    # PSNRs of all sources are computed together so that the device is only synchronized once
+                    psnr_pairs = []
+                    # the segmentation and the latent space of a source do not depend on the target. They are exported
+                    # with the first target only, so the (large) latent space is not aggregated again for every target
+                    for src_start in range(0, num_src, self.max_src_batch):
+                        src_end = min(src_start + self.max_src_batch, num_src)
+                        batch_predictions = self.predict_logits_from_preprocessed_data(data_for_prediction[src_start:src_end], tgt_code, keep_on_device=keep_on_device, return_latent=save_latent_space and tgt_seq == 0)
+                        src_predictions += zip(*[i.chunk(src_end - src_start, dim=0) if i is not None else
+                                                 [None] * (src_end - src_start) for i in batch_predictions])
+                    for src_idx, src_seq in enumerate(available_channel):
+                        prediction, prediction_mask, prediction_latent = src_predictions[src_idx]
+                        prediction_mask = self._mask_to_segmentation(prediction_mask)
+                        # the latent space was upsampled 4x for aggregation. Take every 4th voxel, which is what nearest
+                        # neighbour interpolation with scale_factor=0.25 picks (including the output size), and only
+                        # cast the (much smaller) result
+                        if prediction_latent is not None:
+                            prediction_latent = prediction_latent[(slice(None),) + tuple(
+                                slice(0, (n // 4) * 4, 4) for n in prediction_latent.shape[1:])].float().contiguous()
+
+                        if tgt_seq in available_channel:
+                            tgt_idx = available_channel.index(tgt_seq)
+                            tgt_data = data_for_prediction[tgt_idx:tgt_idx+1].to(prediction.device)
+                            hm_prediction = linearMatch(prediction, tgt_data)
                             #hm_prediction = histMatch(prediction[0], data[tgt_idx], is_torch=True).unsqueeze(0)
                             #hm_prediction = prediction
-                            md += torch.abs(hm_prediction-data[tgt_idx:tgt_idx+1])
-                            psnr = torch_PSNR(data[tgt_idx:tgt_idx+1], hm_prediction, data_range=1).item()
-                            self.one2one_translate_psnr[src_seq][tgt_seq].append(psnr)
+                            md += torch.abs(hm_prediction-tgt_data).to(md.device)
+                            psnr_pairs.append((src_seq, tgt_data.float(), hm_prediction.float()))
+                        if prediction_latent is not None:
+                            prediction, prediction_mask, prediction_latent = self._move_to_cpu_for_export(
+                                prediction, prediction_mask, prediction_latent)
+                        else:
+                            prediction, prediction_mask = self._move_to_cpu_for_export(prediction, prediction_mask)
 
                         if ofile is not None:
                             # this needs to go into background processes
                             # export_prediction_from_logits(prediction, properties, self.configuration_manager, self.plans_manager,
                             #                               self.dataset_json, ofile, save_probabilities)
                             print('sending off prediction to background worker for resampling and export')
-                            os.makedirs(os.path.join(ofile, 'normalized_source_images'), exist_ok=True)
                             if tgt_seq==0:
-                                r.append(
-                                    export_pool.starmap_async(
-                                        export_prediction_from_logits,
-                                        ((data[src_idx:src_idx+1], properties, self.configuration_manager, self.plans_manager,
-                                        self.dataset_json, os.path.join(ofile, 'normalized_source_images', 'norm_src_{}'.format(src_seq)), save_probabilities),)
-                                    )
-                                )
+                                pending_exports.append((src_data[src_idx], properties, self.configuration_manager, self.plans_manager,
+                                    self.dataset_json, os.path.join(ofile, 'normalized_source_images', 'norm_src_{}'.format(src_seq)), save_probabilities))
                             
-                            os.makedirs(os.path.join(ofile, 'one2one_inference'), exist_ok=True)
-                            r.append(
-                                export_pool.starmap_async(
-                                    export_prediction_from_logits,
-                                    ((prediction, properties, self.configuration_manager, self.plans_manager,
-                                    self.dataset_json, os.path.join(ofile, 'one2one_inference', 'translate_src_{}_to_tgt_{}'.format(src_seq, tgt_seq)), save_probabilities),)
-                                )
-                            )
-                            r.append(
-                                export_pool.starmap_async(
-                                    export_prediction_from_logits,
-                                    ((prediction_mask, properties, self.configuration_manager, self.plans_manager,
-                                    self.dataset_json, os.path.join(ofile, 'one2one_inference', 'segment_src_{}'.format(src_seq)), save_probabilities),)
-                                )
-                            )
-                            os.makedirs(os.path.join(ofile, 'latent_space'), exist_ok=True)
-                            r.append(
-                                export_pool.starmap_async(
-                                    export_prediction_from_logits,
-                                    ((prediction_latent, properties, self.configuration_manager, self.plans_manager,
-                                    self.dataset_json, os.path.join(ofile, 'latent_space', 'latent_space_src_{}'.format(src_seq)), save_probabilities, True),)
-                                )
-                            )
-
-                            if src_idx==len(properties['available_channel'])-1:
-                                os.makedirs(os.path.join(ofile, 'explainability_visualization/imaging_differentiation_map'), exist_ok=True)
-                                
-                                md /= len(properties['available_channel'])
+                            pending_exports.append((prediction, properties, self.configuration_manager, self.plans_manager,
+                                self.dataset_json, os.path.join(ofile, 'one2one_inference', 'translate_src_{}_to_tgt_{}'.format(src_seq, tgt_seq)), save_probabilities))
+                            if tgt_seq==0:
+                                pending_exports.append((prediction_mask, properties, self.configuration_manager, self.plans_manager,
+                                    self.dataset_json, os.path.join(ofile, 'one2one_inference', 'segment_src_{}'.format(src_seq)), save_probabilities))
+                            if prediction_latent is not None:
+                                pending_exports.append((prediction_latent, properties, self.configuration_manager, self.plans_manager,
+                                    self.dataset_json, os.path.join(ofile, 'latent_space', 'latent_space_src_{}'.format(src_seq)), save_probabilities, True))
+
+                            if src_idx==num_src-1:
+                                md /= num_src
+                                md, = self._move_to_cpu_for_export(md)
                                 
-                                if tgt_seq in properties['available_channel']:
-                                    r.append(
-                                        export_pool.starmap_async(
-                                            export_prediction_from_logits,
-                                            ((md, properties, self.configuration_manager, self.plans_manager,
-                                            self.dataset_json, os.path.join(ofile, 'explainability_visualization/imaging_differentiation_map', 'imaging_differentiation_map_tgt_{}'.format(tgt_seq)), save_probabilities),)
-                                        )
-                                    )
+                                if tgt_seq in available_channel:
+                                    pending_exports.append((md, properties, self.configuration_manager, self.plans_manager,
+                                        self.dataset_json, os.path.join(ofile, 'explainability_visualization/imaging_differentiation_map', 'imaging_differentiation_map_tgt_{}'.format(tgt_seq)), save_probabilities))
                         else:
                             # convert_predicted_logits_to_segmentation_with_correct_shape(
                             #             prediction, self.plans_manager,
@@ -495,47 +725,53 @@ class nnSeq2SeqPredictor(object):
                             #              save_probabilities)
 
                             print('sending off prediction to background worker for resampling')
+                            self._wait_for_export_copies()
                             r.append(
-                                export_pool.starmap_async(
-                                    convert_predicted_logits_to_segmentation_with_correct_shape, (
-                                        (prediction, self.plans_manager,
-                                        self.configuration_manager, self.label_manager,
-                                        properties,
-                                        save_probabilities),)
+                                self._submit_to_export_pool(
+                                    export_pool, worker_list, export_semaphore, export_queue_size,
+                                    convert_predicted_logits_to_segmentation_with_correct_shape,
+                                    [(prediction, self.plans_manager,
+                                      self.configuration_manager, self.label_manager,
+                                      properties,
+                                      save_probabilities)]
                                 )
                             )
                         if ofile is not None:
                             print(f'done with {os.path.basename(ofile)} from src {src_seq} to tgt {tgt_seq}')
                         else:
                             print(f'\nDone with image of shape {data.shape}:')
-            ret = [i.get()[0] for i in r]
+                    if len(psnr_pairs) > 0:
+                        psnrs = torch_PSNR(torch.stack([i[1] for i in psnr_pairs]), torch.stack([i[2] for i in psnr_pairs]),
+                                           data_range=1, reduction='none').cpu().tolist()
+                        for (src_seq, _, _), psnr in zip(psnr_pairs, psnrs):
+                            self.one2one_translate_psnr[src_seq][tgt_seq].append(psnr)
+                    # flush the exports of this target right away, as one batch, so that host memory only ever holds
+                    # one target's worth of results plus the bounded export queue
+                    if len(pending_exports) > 0:
+                        self._wait_for_export_copies()
+                        r.append(self._submit_to_export_pool(export_pool, worker_list, export_semaphore,
+                                                             export_queue_size, export_prediction_from_logits,
+                                                             pending_exports))
+                        pending_exports = []
+            ret = self._collect_export_results(r, worker_list)
 
         if isinstance(data_iterator, MultiThreadedAugmenter):
             data_iterator._finish()
         
         # calculate synthesis-based sequence contribution
-        sbsc = []
         N = self.network.tsf.num_channel
-        A = [[0 for i in range(N)] for i in range(N)]
         eps = 1e-9
-        all_psnr = []
-        for p1 in self.one2one_translate_psnr:
-            for p2 in p1:
-                all_psnr += p2
-        for i in range(N):
-            for j in range(N):
-                if len(self.one2one_translate_psnr[i][j])==0:
-                    continue
-                A[i][j] = (np.nanmean(self.one2one_translate_psnr[i][j])-np.nanmean(all_psnr))/(np.nanstd(all_psnr) + eps)
-        for i in range(N):
-            metric_ct = 0
-            metric_cd = 0
-            for j in range(N):
-                metric_ct += A[i][j]
-                metric_cd -= A[j][i]
-            metric_ct /= N
-            metric_cd /= N
-            sbsc.append([i, metric_ct, metric_cd])
+        # every (source, target) list is converted to numpy once, everything below works on these arrays
+        pair_psnr = [[np.asarray(self.one2one_translate_psnr[i][j], dtype=np.float64) for j in range(N)]
+                     for i in range(N)]
+        all_psnr = np.concatenate([p for row in pair_psnr for p in row])
+        psnr_mean, psnr_std = np.nanmean(all_psnr), np.nanstd(all_psnr) + eps
+        # pairs that were never evaluated do not contribute
+        A = np.array([[(np.nanmean(pair_psnr[i][j]) - psnr_mean) / psnr_std if pair_psnr[i][j].size > 0 else 0
+                       for j in range(N)] for i in range(N)])
+        metric_ct = A.mean(axis=1)
+        metric_cd = -A.mean(axis=0)
+        sbsc = [[i, metric_ct[i], metric_cd[i]] for i in range(N)]
         df = pd.DataFrame(data=sbsc, columns=['channel', 'metric_ct', 'metric_cd'])
         df.to_csv(join(os.path.dirname(ofile), 'synthesis-based_sequence_contribution.csv'))
 
@@ -545,6 +781,62 @@ class nnSeq2SeqPredictor(object):
         empty_cache(self.device)
         return ret
 
+    @staticmethod
+    def _mask_to_segmentation(prediction_mask: torch.Tensor) -> torch.Tensor:
+        # masks aggregated as running argmax already hold labels
+        if not torch.is_floating_point(prediction_mask):
+            return prediction_mask
+        return torch.argmax(prediction_mask, dim=0, keepdim=True)
+
+    @staticmethod
+    def _ensure_case_dirs(ofile: str, save_latent_space: bool = True):
+        subfolders = ['multi2one_inference', 'explainability_visualization/task-specific_enhanced_map',
+                      'explainability_visualization/imaging_differentiation_map', 'normalized_source_images',
+                      'one2one_inference']
+        if save_latent_space:
+            subfolders.append('latent_space')
+        for subfolder in subfolders:
+            os.makedirs(os.path.join(ofile, subfolder), exist_ok=True)
+
+    @staticmethod
+    def _submit_to_export_pool(export_pool, worker_list: List, export_semaphore: threading.BoundedSemaphore,
+                               export_queue_size: int, func, batch: List[Tuple]):
+        """
+        Hands a batch of export jobs to the pool in a single submission. Every job takes a slot of export_semaphore
+        (which has export_queue_size slots) and the slots are given back once the whole batch is done. A batch that is
+        larger than the queue takes all slots, so it waits for the queue to drain instead of waiting forever
+        """
+        num_slots = min(len(batch), export_queue_size)
+        for _ in range(num_slots):
+            # wake up every now and then to make sure the workers are still alive, otherwise we would wait forever for
+            # a slot that is never released
+            while not export_semaphore.acquire(timeout=1):
+                if not all([i.is_alive() for i in worker_list]):
+                    raise RuntimeError('Some background workers are no longer alive')
+
+        def release(_):
+            for _ in range(num_slots):
+                export_semaphore.release()
+
+        # chunksize 1, so that the jobs of a batch are spread over all workers
+        return export_pool.starmap_async(func, batch, chunksize=1, callback=release, error_callback=release)
+
+    @staticmethod
+    def _collect_export_results(results: List, worker_list: List):
+        """
+        The submitted batches run concurrently in the pool, so a slow case does not hold up the ones after it. Only the
+        results are returned in submission order, one per job, which is what callers rely on. Instead of blocking on one
+        job after the other we wait on whatever is still running and keep an eye on the workers, so that a crashed
+        worker raises instead of hanging forever
+        """
+        pending = [i for i in results if not i.ready()]
+        while len(pending) > 0:
+            pending[0].wait(timeout=1)
+            pending = [i for i in pending if not i.ready()]
+            if len(pending) > 0 and not all([i.is_alive() for i in worker_list]):
+                raise RuntimeError('Some background workers are no longer alive')
+        return [j for i in results for j in i.get()]
+
     def predict_single_npy_array(self, input_image: np.ndarray, image_properties: dict,
                                  segmentation_previous_stage: np.ndarray = None,
                                  output_file_truncated: str = None,
@@ -585,8 +877,14 @@ class nnSeq2SeqPredictor(object):
             else:
                 return ret
 
-    def predict_logits_from_preprocessed_data(self, data: torch.Tensor, target_code: torch.Tensor, properties=None, with_attn: bool=True) -> torch.Tensor:
+    def predict_logits_from_preprocessed_data(self, data: torch.Tensor, target_code: torch.Tensor, properties=None, with_attn: Union[bool, str]=True,
+                                              keep_on_device: bool = False, return_latent: bool = True) -> torch.Tensor:
         """
+        with_attn='both' returns the translation with and without attention stacked along the channel axis (in that
+        order) from a single sliding window pass.
+
+        With return_latent=False the latent space is not aggregated and None is returned in its place.
+
         IMPORTANT! IF YOU ARE RUNNING THE CASCADE, THE SEGMENTATION FROM THE PREVIOUS STAGE MUST ALREADY BE STACKED ON
         TOP OF THE IMAGE AS ONE-HOT REPRESENTATION! SEE PreprocessAdapter ON HOW THIS SHOULD BE DONE!
 
@@ -595,47 +893,50 @@ class nnSeq2SeqPredictor(object):
         """
         n_threads = torch.get_num_threads()
         torch.set_num_threads(8 if 8 < n_threads else n_threads)
-        with torch.no_grad():
-            prediction = None
-            prediction_mask = None
-            prediction_latent = None
+        with torch.inference_mode():
+            results = None
 
             for params in self.list_of_parameters:
 
-                # messing with state dict names...
-                if not isinstance(self.network, OptimizedModule):
-                    self.network.load_state_dict(params)
-                else:
-                    self.network._orig_mod.load_state_dict(params)
+                self._load_network_parameters(params)
 
                 # why not leave prediction on device if perform_everything_on_device? Because this may cause the
                 # second iteration to crash due to OOM. Grabbing that with try except cause way more bloated code than
-                # this actually saves computation time
-                if prediction is None:
-                    prediction, prediction_mask, prediction_latent = self.predict_sliding_window_return_logits(data, target_code, properties, with_attn)
-                    prediction = prediction.to('cpu')
-                    prediction_mask = prediction_mask.to('cpu')
-                    prediction_latent = prediction_latent.to('cpu')
-                else:
-                    pred, pred_mask, pred_latent = self.predict_sliding_window_return_logits(data, target_code, properties, with_attn)
-                    prediction += pred.to('cpu')
-                    prediction_mask += pred_mask.to('cpu')
-                    prediction_latent += pred_latent.to('cpu')
+                # this actually saves computation time. With keep_on_device the caller accepts that risk and the
+                # results stay wherever the sliding window put them (which is the CPU if it ran OOM)
+                fold_results = self.predict_sliding_window_return_logits(data, target_code, properties, with_attn,
+                                                                         return_latent)
+                if results is None:
+                    # the first fold becomes the accumulator, all later folds are added to it in place
+                    results = list(fold_results) if keep_on_device else \
+                        [i.to('cpu') if i is not None else None for i in fold_results]
+                    continue
+                for acc, res in zip(results, fold_results):
+                    if acc is not None:
+                        acc.add_(res.to(acc.device))
+                # drop this fold's outputs before the next fold starts allocating its buffers.
+                # predict_sliding_window_return_logits empties the device cache at its start
+                del fold_results
 
             if len(self.list_of_parameters) > 1:
-                prediction /= len(self.list_of_parameters)
-                prediction_mask /= len(self.list_of_parameters)
-                prediction_latent /= len(self.list_of_parameters)
+                for acc in results:
+                    if acc is not None:
+                        acc.mul_(1. / len(self.list_of_parameters))
 
             if self.verbose: print('Prediction done')
-            prediction = prediction.to('cpu')
-            prediction_mask = prediction_mask.to('cpu')
-            prediction_latent = prediction_latent.to('cpu')
+            prediction, prediction_mask, prediction_latent = results
         torch.set_num_threads(n_threads)
         return prediction, prediction_mask, prediction_latent
 
     def _internal_get_sliding_window_slicers(self, image_size: Tuple[int, ...]):
-        slicers = []
+        # the schedule only depends on the image size once the model is loaded. All targets (and usually many cases)
+        # share it, so it is computed once per shape. Only the most recently used shapes are kept
+        key = (tuple(image_size), tuple(self.configuration_manager.patch_size), self.tile_step_size)
+        if key in self._sliding_window_slicers_cache:
+            # move to the end, the entry is now the most recently used one
+            slicers = self._sliding_window_slicers_cache.pop(key)
+            self._sliding_window_slicers_cache[key] = slicers
+            return slicers
         if len(self.configuration_manager.patch_size) < len(image_size):
             assert len(self.configuration_manager.patch_size) == len(
                 image_size) - 1, 'if tile_size has less entries than image_size, ' \
@@ -648,56 +949,108 @@ class nnSeq2SeqPredictor(object):
             if self.verbose: print(f'n_steps {image_size[0] * len(steps[0]) * len(steps[1])}, image size is'
                                    f' {image_size}, tile_size {self.configuration_manager.patch_size}, '
                                    f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
-            for d in range(image_size[0]):
-                for sx in steps[0]:
-                    for sy in steps[1]:
-                        slicers.append(
-                            tuple([slice(None), d, *[slice(si, si + ti) for si, ti in
-                                                     zip((sx, sy), self.configuration_manager.patch_size)]]))
+            # the slices of every axis are built once and combined, instead of being rebuilt for every tile
+            axis_slices = [[slice(si, si + ti) for si in steps_i]
+                           for steps_i, ti in zip(steps, self.configuration_manager.patch_size)]
+            slicers = [(slice(None), d, *sls) for d in range(image_size[0]) for sls in itertools.product(*axis_slices)]
         else:
             steps = compute_steps_for_sliding_window(image_size, self.configuration_manager.patch_size,
                                                      self.tile_step_size)
             if self.verbose: print(
                 f'n_steps {np.prod([len(i) for i in steps])}, image size is {image_size}, tile_size {self.configuration_manager.patch_size}, '
                 f'tile_step_size {self.tile_step_size}\nsteps:\n{steps}')
-            for sx in steps[0]:
-                for sy in steps[1]:
-                    for sz in steps[2]:
-                        slicers.append(
-                            tuple([slice(None), *[slice(si, si + ti) for si, ti in
-                                                  zip((sx, sy, sz), self.configuration_manager.patch_size)]]))
+            axis_slices = [[slice(si, si + ti) for si in steps_i]
+                           for steps_i, ti in zip(steps, self.configuration_manager.patch_size)]
+            slicers = [(slice(None), *sls) for sls in itertools.product(*axis_slices)]
+        self._sliding_window_slicers_cache[key] = slicers
+        if len(self._sliding_window_slicers_cache) > self._sliding_window_slicers_cache_size:
+            del self._sliding_window_slicers_cache[next(iter(self._sliding_window_slicers_cache))]
         return slicers
 
-    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor, target_code: torch.Tensor, properties=None, with_attn: bool=True) -> torch.Tensor:
-        mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
-        if properties is None:
-            prediction, latent_space, _ = self.network(x, target_code, with_latent=True)
-            prediction_mask = self.network.segmentor(latent_space)
+    def _internal_tsf_predict(self, latent_tsf: torch.Tensor, target_code: torch.Tensor, tsf_tgt_code: torch.Tensor,
+                              tsf_seg_code: torch.Tensor, with_attn: Union[bool, str] = True):
+        """
+        with_attn='both' decodes the fused latent with and without attention from the same encoder features. The
+        returned prediction then has two channels: (with attention, without attention). Mask and latent space are
+        the ones with attention.
+        """
+        latent_tsf_tgt, latent_tsf_tgt_finetune = self.network.tsf(latent_tsf, tsf_tgt_code)
+        latent_tsf_seg, latent_tsf_seg_finetune = self.network.tsf(latent_tsf, tsf_seg_code)
+        if with_attn == 'both':
+            prediction = self.network.hyper_decoder(torch.cat([latent_tsf_tgt_finetune, latent_tsf_tgt], dim=0),
+                                                    target_code)
+            prediction = torch.cat(prediction.chunk(2, dim=0), dim=1)
+            prediction_mask = self.network.segmentor(latent_tsf_seg_finetune)
+            latent_space = latent_tsf_tgt_finetune
+        elif with_attn:
+            prediction = self.network.hyper_decoder(latent_tsf_tgt_finetune, target_code)
+            prediction_mask = self.network.segmentor(latent_tsf_seg_finetune)
+            latent_space = latent_tsf_tgt_finetune
         else:
-            tsf_data = [torch.zeros_like(x[:,0:1]) for _ in range(properties['num_channel'])]
-            for i, seq_i in enumerate(properties['available_channel']):
-                tsf_data[seq_i] = x[:, i:i+1]
-            tsf_data = torch.cat(tsf_data, dim=1)
-            tsf_data = tsf_data.view(-1,1,*x.shape[2:]).to(self.device, non_blocking=True)
+            prediction = self.network.hyper_decoder(latent_tsf_tgt, target_code)
+            prediction_mask = self.network.segmentor(latent_tsf_seg)
+            latent_space = latent_tsf_tgt
+        return prediction, prediction_mask, latent_space
+
+    def _get_tsf_data(self, x: torch.Tensor, properties: dict) -> torch.Tensor:
+        # every channel of the fusion input is encoded separately, missing channels are filled with zeros
+        tsf_data = [torch.zeros_like(x[:,0:1]) for _ in range(properties['num_channel'])]
+        for i, seq_i in enumerate(properties['available_channel']):
+            tsf_data[seq_i] = x[:, i:i+1]
+        tsf_data = torch.cat(tsf_data, dim=1)
+        return tsf_data.view(-1,1,*x.shape[2:]).to(self.device, non_blocking=True)
+
+    def _multi2one_forward(self, tsf_data: Optional[torch.Tensor], target_code: torch.Tensor,
+                           tsf_tgt_code: torch.Tensor, tsf_seg_code: torch.Tensor, with_attn: Union[bool, str],
+                           view_axes: Tuple, num_tiles: int, latent_tsf: Optional[torch.Tensor] = None):
+        """
+        Encoder, fusion and decoders of the multi-to-one translation for a batch of tiles and the mirrored views given
+        by view_axes (the flip axes of every view, () for the unflipped one). Shapes are the same for every tile, which
+        is why this is the part that gets compiled.
+
+        With encoder_flip_equivariant the caller encodes the tiles once and passes latent_tsf instead of tsf_data
+        """
+        if latent_tsf is None:
+            if self._encoder_channels_last:
+                tsf_data = tsf_data.contiguous(memory_format=self._get_encoder_memory_format())
+            tsf_data = self._stack_views(tsf_data, view_axes)
             latent_tsf, _ = self.network.image_encoder(tsf_data)
-            latent_tsf = latent_tsf.reshape(x.shape[0], -1, *latent_tsf.shape[2:])
-            
-            tsf_src_code = torch.from_numpy(np.array([1 if i in properties['available_channel'] else 0 for i in range(properties['num_channel'])])).unsqueeze(0).to(self.device, non_blocking=True)
-            tsf_tgt_code = torch.cat([tsf_src_code, target_code, torch.zeros((target_code.shape[0],1), device=self.device)], dim=1)
-            tsf_seg_code = torch.cat([tsf_src_code, torch.zeros_like(target_code), torch.ones((target_code.shape[0],1), device=self.device)], dim=1)
-
-            latent_tsf_tgt, latent_tsf_tgt_finetune = self.network.tsf(latent_tsf, tsf_tgt_code)
-            latent_tsf_seg, latent_tsf_seg_finetune = self.network.tsf(latent_tsf, tsf_seg_code)
-            if with_attn:
-                prediction = self.network.hyper_decoder(latent_tsf_tgt_finetune, target_code)
-                prediction_mask = self.network.segmentor(latent_tsf_seg_finetune)
-                latent_space = latent_tsf_tgt_finetune
-            else:
-                prediction = self.network.hyper_decoder(latent_tsf_tgt, target_code)
-                prediction_mask = self.network.segmentor(latent_tsf_seg)
-                latent_space = latent_tsf_tgt
-            
+            del tsf_data
+        else:
+            # mirror the latent space instead of encoding every mirrored view
+            latent_tsf = self._stack_views(latent_tsf, view_axes)
+        latent_tsf = latent_tsf.reshape(len(view_axes) * num_tiles, -1, *latent_tsf.shape[2:])
+        return self._internal_tsf_predict(latent_tsf, target_code, tsf_tgt_code, tsf_seg_code, with_attn)
+
+    @staticmethod
+    def _stack_views(x: torch.Tensor, view_axes: Tuple) -> torch.Tensor:
+        # mirrored views of x stacked along the batch axis. A single unflipped view is x itself, not a copy
+        views = [torch.flip(x, axes) if len(axes) > 0 else x for axes in view_axes]
+        return views[0] if len(views) == 1 else torch.cat(views, dim=0)
+
+    def _get_encoder_memory_format(self):
+        return torch.channels_last_3d if len(self.configuration_manager.patch_size) == 3 else torch.channels_last
 
+    def _get_tsf_codes(self, properties: dict, target_code: torch.Tensor):
+        """
+        Style codes of the fusion module for the translation and the segmentation task. They only depend on the
+        available channels and the target, so they are built once per sliding window pass instead of once per tile
+        """
+        tsf_src_code = torch.as_tensor([[1 if i in properties['available_channel'] else 0
+                                         for i in range(properties['num_channel'])]],
+                                       dtype=target_code.dtype, device=self.device)
+        target_code = target_code.to(self.device)
+        tsf_tgt_code = torch.cat([tsf_src_code, target_code, torch.zeros((target_code.shape[0], 1), dtype=target_code.dtype, device=self.device)], dim=1)
+        tsf_seg_code = torch.cat([tsf_src_code, torch.zeros_like(target_code), torch.ones((target_code.shape[0], 1), dtype=target_code.dtype, device=self.device)], dim=1)
+        return tsf_tgt_code, tsf_seg_code
+
+    def _internal_maybe_mirror_and_predict(self, x: torch.Tensor, target_code: torch.Tensor, properties=None, with_attn: Union[bool, str]=True,
+                                           tsf_codes: Optional[Tuple[torch.Tensor, torch.Tensor]] = None,
+                                           max_views_per_forward: Optional[int] = None) -> torch.Tensor:
+        if max_views_per_forward is None:
+            max_views_per_forward = self.max_views_per_forward
+        mirror_axes = self.allowed_mirroring_axes if self.use_mirroring else None
+        axes_combinations = []
         if mirror_axes is not None:
             # check for invalid numbers in mirror_axes
             # x should be 5d for 3d images and 4d for 2d. so the max value of mirror_axes cannot exceed len(x.shape) - 3
@@ -706,40 +1059,157 @@ class nnSeq2SeqPredictor(object):
             axes_combinations = [
                 c for i in range(len(mirror_axes)) for c in itertools.combinations([m + 2 for m in mirror_axes], i + 1)
             ]
-            for axes in axes_combinations:
-                if properties is None:
-                    pred, latent, _ = self.network(torch.flip(x, (*axes,)), target_code, with_latent=True)
-                    pred_mask = self.network.segmentor(latent)
-                else:
-                    latent_tsf, _ = self.network.image_encoder(torch.flip(tsf_data, (*axes,)))
-                    latent_tsf = latent_tsf.reshape(x.shape[0], -1, *latent_tsf.shape[2:])
-                    
-                    latent_tsf_tgt, latent_tsf_tgt_finetune = self.network.tsf(latent_tsf, tsf_tgt_code)
-                    latent_tsf_seg, latent_tsf_seg_finetune = self.network.tsf(latent_tsf, tsf_seg_code)
-                    if with_attn:
-                        pred = self.network.hyper_decoder(latent_tsf_tgt_finetune, target_code)
-                        pred_mask = self.network.segmentor(latent_tsf_seg_finetune)
-                        latent = latent_tsf_tgt_finetune
+        # the unflipped view comes first, its outputs start the sums of the merged views
+        view_axes = [()] + axes_combinations
+        num_views = len(view_axes)
+
+        if properties is None:
+            # every channel of x is a separate source image, run them as one batch
+            x_src = x.view(-1, 1, *x.shape[2:])
+        else:
+            tsf_tgt_code, tsf_seg_code = tsf_codes if tsf_codes is not None else self._get_tsf_codes(properties, target_code)
+
+            multi2one_forward = self._compiled_multi2one_forward if self._compiled_multi2one_forward is not None \
+                else self._multi2one_forward
+            tsf_data = self._get_tsf_data(x, properties)
+            latent_tsf = None
+            if self.encoder_flip_equivariant:
+                # the tiles are encoded once, every chunk of views mirrors the same latent space
+                if self._encoder_channels_last:
+                    tsf_data = tsf_data.contiguous(memory_format=self._get_encoder_memory_format())
+                latent_tsf, _ = self.network.image_encoder(tsf_data)
+                tsf_data = None
+
+        # up to max_views_per_forward mirrored views are stacked into the batch of one forward pass. The flips are
+        # undone and the views are added in place. torch.flip has no out argument, but every flipped view is freed right
+        # after it is added, so they all reuse the same allocator block
+        merged = None
+        for i in range(0, num_views, max_views_per_forward):
+            chunk_axes = tuple(view_axes[i:i + max_views_per_forward])
+            if properties is None:
+                prediction, latent_space, _ = self.network(self._stack_views(x_src, chunk_axes), target_code,
+                                                           with_latent=True)
+                prediction_mask = self.network.segmentor(latent_space)
+            else:
+                prediction, prediction_mask, latent_space = multi2one_forward(tsf_data, target_code, tsf_tgt_code,
+                                                                              tsf_seg_code, with_attn, chunk_axes,
+                                                                              x.shape[0], latent_tsf)
+            if num_views == 1:
+                break
+            if merged is None:
+                merged = [None] * 3
+            for j, out in enumerate((prediction, prediction_mask, latent_space)):
+                for axes, view in zip(chunk_axes, out.chunk(len(chunk_axes), dim=0)):
+                    if merged[j] is None:
+                        # the unflipped view. The views come in the autocast dtype of the network. The sum is kept in
+                        # at least the aggregation dtype, so bf16 outputs are not accumulated with 8 mantissa bits
+                        merged[j] = view.to(torch.promote_types(view.dtype, self._get_aggregation_dtype()), copy=True)
                     else:
-                        pred = self.network.hyper_decoder(latent_tsf_tgt, target_code)
-                        pred_mask = self.network.segmentor(latent_tsf_seg)
-                        latent = latent_tsf_tgt
-                prediction += torch.flip(pred, (*axes,))
-                prediction_mask += torch.flip(pred_mask, (*axes,))
-                latent_space += torch.flip(latent, (*axes,))
-            prediction /= (len(axes_combinations) + 1)
-            prediction_mask /= (len(axes_combinations) + 1)
-            latent_space /= (len(axes_combinations) + 1)
+                        merged[j].add_(torch.flip(view, axes))
+            del prediction, prediction_mask, latent_space, out, view
+        if num_views > 1:
+            prediction, prediction_mask, latent_space = [m.div_(num_views) for m in merged]
+        if properties is None:
+            # fold the sources back into the channel axis: (1, n_src * c, ...)
+            prediction = prediction.reshape(x.shape[0], -1, *prediction.shape[2:])
+            prediction_mask = prediction_mask.reshape(x.shape[0], -1, *prediction_mask.shape[2:])
+            latent_space = latent_space.reshape(x.shape[0], -1, *latent_space.shape[2:])
         return prediction, prediction_mask, latent_space
 
+    def _get_autocast_context(self):
+        # Autocast can be annoying
+        # If the device_type is 'cpu' then it's slow as heck on some CPUs (no auto bfloat16 support detection)
+        # and needs to be disabled.
+        # If the device_type is 'mps' then it will complain that mps is not implemented, even if enabled=False
+        # is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
+        # So autocast will only be active if we have a cuda device.
+        if self.device.type != 'cuda' or self.precision == 'fp32':
+            return dummy_context()
+        if self.precision == 'bf16' and torch.cuda.is_bf16_supported():
+            return torch.autocast(self.device.type, dtype=torch.bfloat16, enabled=True)
+        return torch.autocast(self.device.type, dtype=torch.float16, enabled=True)
+
+    def _get_gaussian(self, device: torch.device) -> torch.Tensor:
+        """
+        The tile size is fixed for a trained model, so the importance map is computed once per dtype and device and
+        kept for all subsequent sliding window passes
+        """
+        sigma_scale = 1. / 8
+        dtype = self._get_aggregation_dtype()
+        key = (tuple(self.configuration_manager.patch_size), sigma_scale, dtype, device)
+        if key not in self._gaussian_cache:
+            self._gaussian_cache[key] = compute_gaussian(tuple(self.configuration_manager.patch_size),
+                                                         sigma_scale=sigma_scale, value_scaling_factor=10,
+                                                         dtype=dtype, device=device)
+        return self._gaussian_cache[key]
+
+    def _get_aggregation_dtype(self) -> torch.dtype:
+        # with precision='bf16' (opt-in) the forward pass runs in bf16, but sums over overlapping tiles are kept in
+        # fp16: bf16 only has 8 mantissa bits and the accumulated intensities would visibly lose precision. fp16 has the
+        # mantissa, we only need to watch out for overflows (see the inf check in the sliding window)
+        return torch.float32 if self.precision == 'fp32' else torch.half
+
+    def _iterate_tile_batches(self, data: torch.Tensor, slicers):
+        """
+        Yields (slicers, tiles on device) for batches of tile_batch_size tiles. If data lives on the host while the
+        network runs on a cuda device, the tiles are staged in page-locked memory and uploaded on a separate stream,
+        one batch ahead, so that the copy overlaps with the forward pass of the previous batch.
+        """
+        tile_batches = [slicers[i:i + self.tile_batch_size] for i in range(0, len(slicers), self.tile_batch_size)]
+        # compiled forwards are specialized to the batch shape (and record one CUDA graph per shape). Pad the last
+        # batch with copies of its last tile instead of triggering a recompilation. Only the tiles of batch_slicers
+        # are aggregated, the padding is predicted and dropped
+        pad_batches = self._compiled_multi2one_forward is not None or isinstance(self.network, OptimizedModule)
+
+        def stack_slicers(batch_slicers):
+            if not pad_batches:
+                return batch_slicers
+            return batch_slicers + [batch_slicers[-1]] * (self.tile_batch_size - len(batch_slicers))
+
+        if self.device.type != 'cuda' or data.device.type != 'cpu':
+            for batch_slicers in tqdm(tile_batches, disable=not self.allow_tqdm):
+                yield batch_slicers, torch.stack([data[sl] for sl in stack_slicers(batch_slicers)]).to(
+                    self.device, non_blocking=False)
+            return
+
+        copy_stream = torch.cuda.Stream(self.device)
+        # double buffering: a staging buffer is only refilled once the upload that last read from it is done
+        staging = [torch.empty((self.tile_batch_size, *data[slicers[0]].shape), dtype=data.dtype, pin_memory=True)
+                   for _ in range(2)]
+        copy_events = [None, None]
+
+        def upload(i):
+            batch_slicers = stack_slicers(tile_batches[i])
+            if copy_events[i % 2] is not None:
+                copy_events[i % 2].synchronize()
+            staged = staging[i % 2][:len(batch_slicers)]
+            torch.stack([data[sl] for sl in batch_slicers], out=staged)
+            with torch.cuda.stream(copy_stream):
+                tiles = staged.to(self.device, non_blocking=True)
+                copy_events[i % 2] = torch.cuda.Event()
+                copy_events[i % 2].record(copy_stream)
+            return tiles
+
+        next_tiles = upload(0)
+        for i in tqdm(range(len(tile_batches)), disable=not self.allow_tqdm):
+            tiles = next_tiles
+            torch.cuda.current_stream(self.device).wait_stream(copy_stream)
+            # tiles were allocated on the copy stream but are consumed on the compute stream
+            tiles.record_stream(torch.cuda.current_stream(self.device))
+            if i + 1 < len(tile_batches):
+                next_tiles = upload(i + 1)
+            yield tile_batches[i], tiles
+
     def _internal_predict_sliding_window_return_logits(self,
                                                        data: torch.Tensor,
                                                        slicers,
                                                        target_code: torch.Tensor,
                                                        do_on_device: bool = True,
-                                                       properties=None, with_attn: bool=True
+                                                       properties=None, with_attn: Union[bool, str]=True,
+                                                       return_latent: bool = True,
+                                                       max_views_per_forward: Optional[int] = None
                                                        ):
-        predicted_logits = n_predictions = prediction = gaussian = workon = None
+        predicted_logits = n_predictions = prediction = prediction_mask = latent_space = gaussian = workon = None
         results_device = self.device if do_on_device else torch.device('cpu')
 
         try:
@@ -753,43 +1223,93 @@ class nnSeq2SeqPredictor(object):
             # preallocate arrays
             if self.verbose:
                 print(f'preallocating results arrays on device {results_device}')
-            predicted_logits = torch.zeros((1, *data.shape[1:]),
-                                           dtype=torch.half,
+            # without properties each channel of data is an individual source image that is predicted separately
+            n_src = data.shape[0] if properties is None else 1
+            predicted_logits = torch.zeros(((2 if with_attn == 'both' else 1) * n_src, *data.shape[1:]),
+                                           dtype=self._get_aggregation_dtype(),
                                            device=results_device)
-            predicted_mask_logits = torch.zeros((self.label_manager.num_segmentation_heads, *data.shape[1:]),
-                                           dtype=torch.half,
-                                           device=results_device)
-            predicted_latent_space = torch.zeros((self.network.image_encoder.latent_space_dim, *data.shape[1:]),
-                                           dtype=torch.half,
-                                           device=results_device)
-            n_predictions = torch.zeros(data.shape[1:], dtype=torch.half, device=results_device)
+            num_heads = self.label_manager.num_segmentation_heads
+            # segmentation masks are only ever argmaxed. With a single fold they can be aggregated as a running argmax
+            # (label + best weighted logit per voxel) instead of keeping all heads around
+            mask_running_argmax = self.segmentation_running_argmax and len(self.list_of_parameters) == 1
+            if mask_running_argmax:
+                predicted_mask_logits = torch.zeros((n_src, *data.shape[1:]),
+                                                    dtype=torch.uint8 if num_heads < 256 else torch.int16,
+                                                    device=results_device)
+                predicted_mask_max = torch.full((n_src, *data.shape[1:]),
+                                                torch.finfo(self._get_aggregation_dtype()).min,
+                                                dtype=self._get_aggregation_dtype(), device=results_device)
+            else:
+                predicted_mask_logits = torch.zeros((num_heads * n_src, *data.shape[1:]),
+                                               dtype=self._get_aggregation_dtype(),
+                                               device=results_device)
+            # the latent space is by far the largest buffer, only allocate it if somebody wants it
+            predicted_latent_space = torch.zeros((self.network.image_encoder.latent_space_dim * n_src, *data.shape[1:]),
+                                           dtype=self._get_aggregation_dtype(),
+                                           device=results_device) if return_latent else None
+            # the weight sum is a single channel, keep it in fp32 so that it cannot saturate with many overlapping tiles
+            n_predictions = torch.zeros(data.shape[1:], dtype=torch.float32, device=results_device)
             if self.use_gaussian:
-                gaussian = compute_gaussian(tuple(self.configuration_manager.patch_size), sigma_scale=1. / 8,
-                                            value_scaling_factor=10,
-                                            device=results_device)
+                gaussian = self._get_gaussian(results_device)
+
+            if return_latent:
+                # one full resolution latent tile that is reused for every tile instead of interpolating into a new
+                # tensor each time
+                tile_shape = data[slicers[0]].shape[1:]
+                latent_scratch = torch.empty((predicted_latent_space.shape[0], *tile_shape),
+                                             dtype=self._get_aggregation_dtype(), device=results_device)
+                latent_view = latent_scratch.view(latent_scratch.shape[0], *[j for i in tile_shape for j in (i // 4, 4)])
+                latent_index = (slice(None),) + tuple(j for _ in tile_shape for j in (slice(None), None))
+
+            tsf_codes = self._get_tsf_codes(properties, target_code) if properties is not None else None
 
             if self.verbose: print('running prediction')
-            if not self.allow_tqdm and self.verbose: print(f'{len(slicers)} steps')
-            for sl in tqdm(slicers, disable=not self.allow_tqdm):
-                workon = data[sl][None]
-                workon = workon.to(self.device, non_blocking=False)
-
-                prediction, prediction_mask, latent_space = self._internal_maybe_mirror_and_predict(workon, target_code, properties, with_attn)
-                prediction = prediction[0].to(results_device)
-                prediction_mask = prediction_mask[0].to(results_device)
-                latent_space = F.interpolate(latent_space, scale_factor=4)[0].to(results_device)
-
-                predicted_logits[sl] += (prediction * gaussian if self.use_gaussian else prediction)
-                predicted_mask_logits[sl] += (prediction_mask * gaussian if self.use_gaussian else prediction_mask)
-                predicted_latent_space[sl] += (latent_space * gaussian if self.use_gaussian else latent_space)
-                n_predictions[sl[1:]] += (gaussian if self.use_gaussian else 1)
-                
+            if not self.allow_tqdm and self.verbose: print(f'{len(slicers)} steps, {self.tile_batch_size} per batch')
+            # tile_batch_size tiles are stacked along the batch axis and predicted together
+            for batch_slicers, workon in self._iterate_tile_batches(data, slicers):
+                prediction, prediction_mask, latent_space = self._internal_maybe_mirror_and_predict(workon, target_code, properties, with_attn, tsf_codes,
+                                                                                                    max_views_per_forward)
+                prediction = prediction.to(results_device)
+                prediction_mask = prediction_mask.to(results_device)
+                if return_latent:
+                    latent_space = latent_space.to(results_device)
+
+                # weighting and accumulation are fused (addcmul_), so no weighted copy of the tile is allocated
+                for k, sl in enumerate(batch_slicers):
+                    if self.use_gaussian:
+                        predicted_logits[sl].addcmul_(prediction[k], gaussian)
+                    else:
+                        predicted_logits[sl].add_(prediction[k])
+                    if mask_running_argmax:
+                        weighted_mask = (prediction_mask[k] * gaussian if self.use_gaussian else prediction_mask[k])
+                        tile_max, tile_labels = weighted_mask.view(n_src, num_heads, *weighted_mask.shape[1:]).max(dim=1)
+                        region_max, region_labels = predicted_mask_max[sl], predicted_mask_logits[sl]
+                        better = tile_max > region_max
+                        region_labels.copy_(torch.where(better, tile_labels.to(region_labels.dtype), region_labels))
+                        region_max.copy_(torch.where(better, tile_max.to(region_max.dtype), region_max))
+                    elif self.use_gaussian:
+                        predicted_mask_logits[sl].addcmul_(prediction_mask[k], gaussian)
+                    else:
+                        predicted_mask_logits[sl].add_(prediction_mask[k])
+                    if return_latent:
+                        # nearest neighbour upsampling (the encoder downsamples by 4) written straight into the scratch
+                        # buffer
+                        latent_view.copy_(latent_space[k][latent_index])
+                        if self.use_gaussian:
+                            predicted_latent_space[sl].addcmul_(latent_scratch, gaussian)
+                        else:
+                            predicted_latent_space[sl].add_(latent_scratch)
+                    n_predictions[sl[1:]] += (gaussian if self.use_gaussian else 1)
+
 
             predicted_logits /= n_predictions
-            predicted_mask_logits /= n_predictions
-            predicted_latent_space /= n_predictions
-            # check for infs
-            if torch.any(torch.isinf(predicted_logits)):
+            if not mask_running_argmax:
+                predicted_mask_logits /= n_predictions
+            if return_latent:
+                predicted_latent_space /= n_predictions
+            # check for infs. Only half precision buffers can overflow during aggregation, the check costs a full pass
+            # over the logits plus a sync, so skip it otherwise
+            if predicted_logits.dtype == torch.half and torch.any(torch.isinf(predicted_logits)):
                 raise RuntimeError('Encountered inf in predicted array. Aborting... If this problem persists, '
                                    'reduce value_scaling_factor in compute_gaussian or increase the dtype of '
                                    'predicted_logits to fp32')
@@ -800,7 +1320,8 @@ class nnSeq2SeqPredictor(object):
             raise e
         return predicted_logits, predicted_mask_logits, predicted_latent_space
 
-    def predict_sliding_window_return_logits(self, input_image: torch.Tensor, target_code: torch.Tensor, properties=None, with_attn: bool=True) \
+    def predict_sliding_window_return_logits(self, input_image: torch.Tensor, target_code: torch.Tensor, properties=None, with_attn: Union[bool, str]=True,
+                                             return_latent: bool = True) \
             -> Union[np.ndarray, torch.Tensor]:
         assert isinstance(input_image, torch.Tensor)
         self.network = self.network.to(self.device)
@@ -808,14 +1329,8 @@ class nnSeq2SeqPredictor(object):
 
         empty_cache(self.device)
 
-        # Autocast can be annoying
-        # If the device_type is 'cpu' then it's slow as heck on some CPUs (no auto bfloat16 support detection)
-        # and needs to be disabled.
-        # If the device_type is 'mps' then it will complain that mps is not implemented, even if enabled=False
-        # is set. Whyyyyyyy. (this is why we don't make use of enabled=False)
-        # So autocast will only be active if we have a cuda device.
-        with torch.no_grad():
-            with torch.autocast(self.device.type, enabled=True) if self.device.type == 'cuda' else dummy_context():
+        with torch.inference_mode():
+            with self._get_autocast_context():
                 assert input_image.ndim == 4, 'input_image must be a 4D np.ndarray or torch.Tensor (c, x, y, z)'
 
                 if self.verbose: print(f'Input shape: {input_image.shape}')
@@ -830,27 +1345,64 @@ class nnSeq2SeqPredictor(object):
                 slicers = self._internal_get_sliding_window_slicers(data.shape[1:])
 
                 if self.perform_everything_on_device and self.device != 'cpu':
-                    # we need to try except here because we can run OOM in which case we need to fall back to CPU as a results device
-                    try:
-                        predicted_logits, predicted_mask_logits, predicted_latent_space = self._internal_predict_sliding_window_return_logits(data, slicers, target_code,
-                                                                                               self.perform_everything_on_device, properties, with_attn)
-                    except RuntimeError:
+                    # we need to try except here because we can run OOM. Then fewer mirrored views are stacked into one
+                    # forward pass, and once that is down to one view we need to fall back to CPU as a results device.
+                    # The reduced number of views only holds for this image, the next one starts from the configured one
+                    max_views_per_forward = self.max_views_per_forward
+                    predicted = None
+                    while predicted is None:
+                        out_of_memory = False
+                        try:
+                            predicted = self._internal_predict_sliding_window_return_logits(data, slicers, target_code,
+                                                                                            self.perform_everything_on_device, properties, with_attn, return_latent,
+                                                                                            max_views_per_forward)
+                            break
+                        except torch.cuda.OutOfMemoryError:
+                            out_of_memory = True
+                        except RuntimeError:
+                            pass
+                        # retried outside of the except clause, the traceback keeps the tensors of the failed pass alive
+                        empty_cache(self.device)
+                        if out_of_memory and max_views_per_forward > 1:
+                            max_views_per_forward //= 2
+                            print(f'Prediction on device ran out of memory. Retrying with {max_views_per_forward} '
+                                  f'mirrored views per forward pass')
+                            continue
                         print(
                             'Prediction on device was unsuccessful, probably due to a lack of memory. Moving results arrays to CPU')
-                        empty_cache(self.device)
-                        predicted_logits, predicted_mask_logits, predicted_latent_space = self._internal_predict_sliding_window_return_logits(data, slicers, target_code, False, properties, with_attn)
+                        predicted = self._internal_predict_sliding_window_return_logits(data, slicers, target_code, False, properties, with_attn, return_latent,
+                                                                                    max_views_per_forward)
+                    predicted_logits, predicted_mask_logits, predicted_latent_space = predicted
                 else:
                     predicted_logits, predicted_mask_logits, predicted_latent_space = self._internal_predict_sliding_window_return_logits(data, slicers, target_code,
-                                                                                           self.perform_everything_on_device, properties, with_attn)
+                                                                                           self.perform_everything_on_device, properties, with_attn, return_latent)
 
+                # the padded input is not needed anymore, free it before the cache is emptied so that its blocks are
+                # released as well
+                del data
                 empty_cache(self.device)
                 # revert padding
                 predicted_logits = predicted_logits[tuple([slice(None), *slicer_revert_padding[1:]])]
                 predicted_mask_logits = predicted_mask_logits[tuple([slice(None), *slicer_revert_padding[1:]])]
-                predicted_latent_space = predicted_latent_space[tuple([slice(None), *slicer_revert_padding[1:]])]
+                if return_latent:
+                    predicted_latent_space = predicted_latent_space[tuple([slice(None), *slicer_revert_padding[1:]])]
         return predicted_logits, predicted_mask_logits, predicted_latent_space
 
 
+# printed by the predict entry points once the arguments are parsed, so that --help, argument errors and --client
+# calls stay quiet
+_CITATION = \
+    "\n#######################################################################\nPlease cite the following paper " \
+    "when using nnSeq2Seq:\n" \
+    "[1] Han L, Tan T, Zhang T, et al. " \
+    "Synthesis-based imaging-differentiation representation learning for multi-sequence 3D/4D MRI[J]. " \
+    "Medical Image Analysis, 2024, 92: 103044.\n" \
+    "[2] Han L, Zhang T, Huang Y, et al. " \
+    "An Explainable Deep Framework: Towards Task-Specific Fusion for Multi-to-One MRI Synthesis[C]. " \
+    "International Conference on Medical Image Computing and Computer-Assisted Intervention. Cham: Springer Nature Switzerland, 2023: 45-55.\n" \
+    "#######################################################################\n"
+
+
 def predict_entry_point_modelfolder():
     import argparse
     parser = argparse.ArgumentParser(description='Use this to run inference with nnSeq2Seq. This function is used when '
@@ -880,6 +1432,9 @@ def predict_entry_point_modelfolder():
     parser.add_argument('--save_probabilities', action='store_true',
                         help='Set this to export predicted class "probabilities". Required if you want to ensemble '
                              'multiple configurations.')
+    parser.add_argument('--disable_latent_space', action='store_true', required=False, default=False,
+                        help='Set this flag to not export the latent space of the one-to-one translations. Saves '
+                             'a lot of memory and time if you do not need it.')
     parser.add_argument('--continue_prediction', '--c', action='store_true',
                         help='Continue an aborted previous prediction (will not overwrite existing files)')
     parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
@@ -899,20 +1454,39 @@ def predict_entry_point_modelfolder():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
-
-    print(
-        "\n#######################################################################\nPlease cite the following paper "
-        "when using nnSeq2Seq:\n"
-        "[1] Han L, Tan T, Zhang T, et al. "
-        "Synthesis-based imaging-differentiation representation learning for multi-sequence 3D/4D MRI[J]. "
-        "Medical Image Analysis, 2024, 92: 103044.\n"
-        "[2] Han L, Zhang T, Huang Y, et al. "
-        "An Explainable Deep Framework: Towards Task-Specific Fusion for Multi-to-One MRI Synthesis[C]. "
-        "International Conference on Medical Image Computing and Computer-Assisted Intervention. Cham: Springer Nature Switzerland, 2023: 45-55.\n"
-        "#######################################################################\n",)
+    parser.add_argument('-precision', type=str, required=False, default='fp16', choices=['bf16', 'fp16', 'fp32'],
+                        help='Precision of the network forward pass on cuda devices. Default: fp16. bf16 is opt-in, it '
+                             'is never picked automatically and falls back to fp16 on GPUs without bf16 support. Use '
+                             'fp32 to disable mixed precision')
+    parser.add_argument('-tbs', type=int, required=False, default=1,
+                        help='Number of sliding window tiles that are predicted in one forward pass. Larger values use '
+                             'the GPU better but need more VRAM. Default: 1')
+    parser.add_argument('-max_views_per_forward', type=int, required=False, default=1,
+                        help='Number of mirrored views of the test time augmentation (up to 8 in 3d) that are '
+                             'predicted in one forward pass. Larger values use the GPU better but need up to that many '
+                             'times the VRAM of a single view. Halved automatically if the GPU runs out of memory. '
+                             'Default: 1')
+    parser.add_argument('-max_src_batch', type=int, required=False, default=1,
+                        help='Number of source images that go through one sliding window pass together. Larger values '
+                             'use the GPU better but need that many times the VRAM of a single source. Default: 1')
+    parser.add_argument('--compile', action='store_true', required=False, default=False,
+                        help='Compile the network with torch.compile (same as setting nnSeq2Seq_compile=1). Pays off '
+                             'for many cases or large images, the first tiles are slow while the graphs are built.')
+    parser.add_argument('--fold_ensemble', type=str, required=False, default='avg_predictions',
+                        choices=['avg_predictions', 'avg_weights'],
+                        help='How the folds given with -f are combined. avg_predictions runs every fold and averages '
+                             'the predictions. avg_weights averages the weights of the folds into one network that is '
+                             'run once, which is as fast as a single fold. Only use avg_weights if the folds were '
+                             'fine-tuned from the same pretrained weights and check the results on validation data '
+                             'first. Default: avg_predictions')
+    parser.add_argument('--keep_on_device', action='store_true', required=False, default=False,
+                        help='Keep the case and all predictions of a target on the device until they are exported '
+                             'instead of moving them to the CPU after every fold. Faster, but needs considerably more '
+                             'GPU memory. Only used with -device cuda.')
 
     args = parser.parse_args()
     args.f = [i if i == 'all' else int(i) for i in args.f]
+    print(_CITATION)
 
     if not isdir(args.o):
         maybe_mkdir_p(args.o)
@@ -928,10 +1502,19 @@ def predict_entry_point_modelfolder():
         # multithreading in torch doesn't help nnSeq2Seq if run on GPU
         torch.set_num_threads(1)
         torch.set_num_interop_threads(1)
+        # all tiles have the same shape, so the allocator sees the same temporaries over and over again and cudnn only
+        # needs to pick its kernels once. The allocator config has to be set before cuda is initialized
+        os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision('high')
         device = torch.device('cuda')
     else:
         device = torch.device('mps')
 
+    if args.compile:
+        # read in initialize_from_trained_model_folder
+        os.environ['nnSeq2Seq_compile'] = '1'
+
     predictor = nnSeq2SeqPredictor(tile_step_size=args.step_size,
                                 use_gaussian=True,
                                 use_mirroring=not args.disable_tta,
@@ -939,14 +1522,138 @@ def predict_entry_point_modelfolder():
                                 device=device,
                                 verbose=args.verbose,
                                 allow_tqdm=not args.disable_progress_bar,
-                                verbose_preprocessing=args.verbose)
+                                verbose_preprocessing=args.verbose,
+                                precision=args.precision,
+                                tile_batch_size=args.tbs,
+                                max_views_per_forward=args.max_views_per_forward,
+                                max_src_batch=args.max_src_batch,
+                                fold_ensemble=args.fold_ensemble,
+                                keep_on_device=args.keep_on_device)
     predictor.initialize_from_trained_model_folder(args.m, args.f, args.chk)
     predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
                                  overwrite=not args.continue_prediction,
                                  num_processes_preprocessing=args.npp,
                                  num_processes_segmentation_export=args.nps,
                                  folder_with_segs_from_prev_stage=args.prev_stage_predictions,
-                                 num_parts=1, part_id=0)
+                                 num_parts=1, part_id=0,
+                                 save_latent_space=not args.disable_latent_space)
+
+
+# arguments of predict_entry_point that describe a prediction job (as opposed to the model). These are what a
+# --client sends to a --server
+_PREDICTION_JOB_ARGS = ('i', 'o', 'save_probabilities', 'continue_prediction', 'npp', 'nps', 'prev_stage_predictions',
+                        'num_parts', 'part_id', 'disable_latent_space')
+
+
+def _predict_job(predictor: nnSeq2SeqPredictor, job: dict):
+    predictor.predict_from_files(job['i'], job['o'], save_probabilities=job['save_probabilities'],
+                                 overwrite=not job['continue_prediction'],
+                                 num_processes_preprocessing=job['npp'],
+                                 num_processes_segmentation_export=job['nps'],
+                                 folder_with_segs_from_prev_stage=job['prev_stage_predictions'],
+                                 num_parts=job['num_parts'],
+                                 part_id=job['part_id'],
+                                 save_latent_space=not job['disable_latent_space'])
+
+
+def _authkey_file(address: str) -> str:
+    return address + '.key'
+
+
+def _serve_prediction_jobs(predictor: nnSeq2SeqPredictor, address: str):
+    """
+    Keeps the initialized predictor alive and runs the prediction jobs that nnSeq2Seqv2_predict --client sends to
+    the UNIX socket at address, one after another. Runs until the process is killed
+    """
+    # a socket left behind by a server that was killed cannot be bound again. Anything that is not a socket is not
+    # ours to remove
+    if os.path.exists(address):
+        if not stat.S_ISSOCK(os.stat(address).st_mode):
+            raise RuntimeError(f'{address} exists and is not a socket')
+        os.unlink(address)
+    # jobs are pickled, so only the owner may connect. Socket and key file are created under a restrictive umask, there
+    # is no moment in which they are accessible to others. Clients additionally have to prove that they can read the
+    # key file (multiprocessing's HMAC challenge) before anything is unpickled
+    authkey = os.urandom(32)
+    old_umask = os.umask(0o077)
+    try:
+        fd = os.open(_authkey_file(address), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        with os.fdopen(fd, 'wb') as f:
+            # a key file left over from an earlier server keeps its mode when it is truncated
+            os.fchmod(f.fileno(), 0o600)
+            f.write(authkey)
+        listener = Listener(address, family='AF_UNIX', authkey=authkey)
+    except BaseException:
+        _remove_if_exists(_authkey_file(address))
+        raise
+    finally:
+        os.umask(old_umask)
+    if threading.current_thread() is threading.main_thread():
+        # a plain kill ends the server through the finally below, so that socket and key file are removed
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    try:
+        with listener:
+            print(f'Waiting for prediction jobs on {address}')
+            while True:
+                try:
+                    conn = listener.accept()
+                except AuthenticationError:
+                    print('Rejected a connection with a wrong authentication key')
+                    continue
+                except (EOFError, OSError):
+                    # the client went away during the handshake
+                    continue
+                with conn:
+                    _handle_prediction_job(predictor, conn)
+    finally:
+        _remove_if_exists(address)
+        _remove_if_exists(_authkey_file(address))
+
+
+def _handle_prediction_job(predictor: nnSeq2SeqPredictor, conn):
+    # a failed job must not take down the server. The client gets the error instead, if it is still there
+    try:
+        job = conn.recv()
+    except (EOFError, OSError):
+        print('Client disconnected before sending a job')
+        return
+    except Exception as e:
+        # the job could not be unpickled
+        error = f'Malformed prediction job: {e!r}'
+    else:
+        if isinstance(job, dict) and all(k in job for k in _PREDICTION_JOB_ARGS):
+            print(f'Received prediction job {job["i"]} -> {job["o"]}')
+            try:
+                _predict_job(predictor, job)
+                error = None
+            except Exception as e:
+                traceback.print_exc()
+                error = repr(e)
+        else:
+            error = f'Malformed prediction job, expected a dict with the keys {_PREDICTION_JOB_ARGS}'
+    if error is not None:
+        print(error)
+    try:
+        conn.send(error)
+    except (EOFError, OSError):
+        print('Client disconnected before the job was done')
+
+
+def _remove_if_exists(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def _send_prediction_job(address: str, job: dict):
+    with open(_authkey_file(address), 'rb') as f:
+        authkey = f.read()
+    with Client(address, family='AF_UNIX', authkey=authkey) as conn:
+        conn.send(job)
+        error = conn.recv()
+    if error is not None:
+        raise RuntimeError(f'Prediction job failed on the server: {error}')
 
 
 def predict_entry_point():
@@ -960,11 +1667,13 @@ def predict_entry_point():
                              'File endings must be the same as the training dataset!')
     parser.add_argument('-o', type=str, required=True,
                         help='Output folder. If it does not exist it will be created.')
-    parser.add_argument('-d', type=str, required=True,
-                        help='Dataset with which you would like to predict. You can specify either dataset name or id')
-    parser.add_argument('-c', type=str, required=True,
+    # -d and -c are not needed with --client, they are checked once the arguments are parsed
+    parser.add_argument('-d', type=str, required=False, default=None,
+                        help='Dataset with which you would like to predict. You can specify either dataset name or id. '
+                             'Required unless --client is used')
+    parser.add_argument('-c', type=str, required=False, default=None,
                         help='nnSeq2Seq configuration that should be used for prediction. Config must be located '
-                             'in the plans specified with -p')
+                             'in the plans specified with -p. Required unless --client is used')
     parser.add_argument('-p', type=str, required=False, default='nnSeq2SeqPlans',
                         help='Plans identifier. Specify the plans in which the desired configuration is located. '
                              'Default: nnSeq2SeqPlans')
@@ -984,6 +1693,9 @@ def predict_entry_point():
     parser.add_argument('--save_probabilities', action='store_true',
                         help='Set this to export predicted class "probabilities". Required if you want to ensemble '
                              'multiple configurations.')
+    parser.add_argument('--disable_latent_space', action='store_true', required=False, default=False,
+                        help='Set this flag to not export the latent space of the one-to-one translations. Saves '
+                             'a lot of memory and time if you do not need it.')
     parser.add_argument('--continue_prediction', action='store_true',
                         help='Continue an aborted previous prediction (will not overwrite existing files)')
     parser.add_argument('-chk', type=str, required=False, default='checkpoint_final.pth',
@@ -1002,8 +1714,9 @@ def predict_entry_point():
     parser.add_argument('-part_id', type=int, required=False, default=0,
                         help='If multiple nnSeq2Seqv2_predict exist, which one is this? IDs start with 0 can end with '
                              'num_parts - 1. So when you submit 5 nnSeq2Seqv2_predict calls you need to set -num_parts '
-                             '5 and use -part_id 0, 1, 2, 3 and 4. Simple, right? Note: You are yourself responsible '
-                             'to make these run on separate GPUs! Use CUDA_VISIBLE_DEVICES (google, yo!)')
+                             '5 and use -part_id 0, 1, 2, 3 and 4. Simple, right? If a call sees several GPUs, part_id '
+                             'i runs on GPU i %% (number of visible GPUs). Otherwise use CUDA_VISIBLE_DEVICES to put '
+                             'the parts on separate GPUs (google, yo!)')
     parser.add_argument('-device', type=str, default='cuda', required=False,
                         help="Use this to set the device the inference should run with. Available options are 'cuda' "
                              "(GPU), 'cpu' (CPU) and 'mps' (Apple M1/M2). Do NOT use this to set which GPU ID! "
@@ -1011,29 +1724,72 @@ def predict_entry_point():
     parser.add_argument('--disable_progress_bar', action='store_true', required=False, default=False,
                         help='Set this flag to disable progress bar. Recommended for HPC environments (non interactive '
                              'jobs)')
-
-    print(
-        "\n#######################################################################\nPlease cite the following paper "
-        "when using nnSeq2Seq:\n"
-        "[1] Han L, Tan T, Zhang T, et al. "
-        "Synthesis-based imaging-differentiation representation learning for multi-sequence 3D/4D MRI[J]. "
-        "Medical Image Analysis, 2024, 92: 103044.\n"
-        "[2] Han L, Zhang T, Huang Y, et al. "
-        "An Explainable Deep Framework: Towards Task-Specific Fusion for Multi-to-One MRI Synthesis[C]. "
-        "International Conference on Medical Image Computing and Computer-Assisted Intervention. Cham: Springer Nature Switzerland, 2023: 45-55.\n"
-        "#######################################################################\n",)
+    parser.add_argument('-precision', type=str, required=False, default='fp16', choices=['bf16', 'fp16', 'fp32'],
+                        help='Precision of the network forward pass on cuda devices. Default: fp16. bf16 is opt-in, it '
+                             'is never picked automatically and falls back to fp16 on GPUs without bf16 support. Use '
+                             'fp32 to disable mixed precision')
+    parser.add_argument('-tbs', type=int, required=False, default=1,
+                        help='Number of sliding window tiles that are predicted in one forward pass. Larger values use '
+                             'the GPU better but need more VRAM. Default: 1')
+    parser.add_argument('-max_views_per_forward', type=int, required=False, default=1,
+                        help='Number of mirrored views of the test time augmentation (up to 8 in 3d) that are '
+                             'predicted in one forward pass. Larger values use the GPU better but need up to that many '
+                             'times the VRAM of a single view. Halved automatically if the GPU runs out of memory. '
+                             'Default: 1')
+    parser.add_argument('-max_src_batch', type=int, required=False, default=1,
+                        help='Number of source images that go through one sliding window pass together. Larger values '
+                             'use the GPU better but need that many times the VRAM of a single source. Default: 1')
+    parser.add_argument('--compile', action='store_true', required=False, default=False,
+                        help='Compile the network with torch.compile (same as setting nnSeq2Seq_compile=1). Pays off '
+                             'for many cases or large images, the first tiles are slow while the graphs are built.')
+    parser.add_argument('--fold_ensemble', type=str, required=False, default='avg_predictions',
+                        choices=['avg_predictions', 'avg_weights'],
+                        help='How the folds given with -f are combined. avg_predictions runs every fold and averages '
+                             'the predictions. avg_weights averages the weights of the folds into one network that is '
+                             'run once, which is as fast as a single fold. Only use avg_weights if the folds were '
+                             'fine-tuned from the same pretrained weights and check the results on validation data '
+                             'first. Default: avg_predictions')
+    parser.add_argument('--keep_on_device', action='store_true', required=False, default=False,
+                        help='Keep the case and all predictions of a target on the device until they are exported '
+                             'instead of moving them to the CPU after every fold. Faster, but needs considerably more '
+                             'GPU memory. Only used with -device cuda.')
+    parser.add_argument('--server', type=str, required=False, default=None,
+                        help='Path of a UNIX socket. After predicting -i, keep the model loaded and predict the jobs '
+                             'sent with --client to this socket. Saves loading, cudnn autotuning and compilation for '
+                             'every further call. Runs until killed. The socket and its authentication key '
+                             '(<path>.key) are only accessible to the user running the server.')
+    parser.add_argument('--client', type=str, required=False, default=None,
+                        help='Path of the UNIX socket of a running --server. Sends -i, -o and the other job arguments '
+                             '(--save_probabilities, --continue_prediction, -npp, -nps, -prev_stage_predictions, '
+                             '-num_parts, -part_id, --disable_latent_space) to the server and waits until they are '
+                             'predicted. Model and device arguments (-d and -c are not needed) are ignored, the '
+                             'server\'s are used.')
 
     args = parser.parse_args()
     args.f = [i if i == 'all' else int(i) for i in args.f]
 
+    # slightly passive aggressive haha
+    assert args.part_id < args.num_parts, 'Do you even read the documentation? See nnSeq2Seqv2_predict -h.'
+    assert args.server is None or args.client is None, '--server and --client cannot be used together'
+
+    if args.client is not None:
+        job = {k: getattr(args, k) for k in _PREDICTION_JOB_ARGS}
+        # the server runs in a different working directory
+        for k in ('i', 'o', 'prev_stage_predictions'):
+            if job[k] is not None:
+                job[k] = os.path.abspath(job[k])
+        _send_prediction_job(args.client, job)
+        return
+    if args.d is None or args.c is None:
+        parser.error('the following arguments are required: -d, -c (unless --client is used)')
+
+    print(_CITATION)
+
     model_folder = get_output_folder(args.d, args.tr, args.p, args.c)
 
     if not isdir(args.o):
         maybe_mkdir_p(args.o)
 
-    # slightly passive aggressive haha
-    assert args.part_id < args.num_parts, 'Do you even read the documentation? See nnSeq2Seqv2_predict -h.'
-
     assert args.device in ['cpu', 'cuda',
                            'mps'], f'-device must be either cpu, mps or cuda. Other devices are not tested/supported. Got: {args.device}.'
     if args.device == 'cpu':
@@ -1045,10 +1801,24 @@ def predict_entry_point():
         # multithreading in torch doesn't help nnSeq2Seq if run on GPU
         torch.set_num_threads(1)
         torch.set_num_interop_threads(1)
+        # all tiles have the same shape, so the allocator sees the same temporaries over and over again and cudnn only
+        # needs to pick its kernels once. The allocator config has to be set before cuda is initialized
+        os.environ.setdefault('PYTORCH_CUDA_ALLOC_CONF', 'expandable_segments:True')
+        torch.backends.cudnn.benchmark = True
+        torch.set_float32_matmul_precision('high')
         device = torch.device('cuda')
+        if args.num_parts > 1 and torch.cuda.device_count() > 1:
+            # parts that see several GPUs are spread over them round robin. With CUDA_VISIBLE_DEVICES restricted to
+            # one GPU per call nothing changes
+            device = torch.device('cuda', args.part_id % torch.cuda.device_count())
+            torch.cuda.set_device(device)
     else:
         device = torch.device('mps')
 
+    if args.compile:
+        # read in initialize_from_trained_model_folder
+        os.environ['nnSeq2Seq_compile'] = '1'
+
     predictor = nnSeq2SeqPredictor(tile_step_size=args.step_size,
                                 use_gaussian=True,
                                 use_mirroring=not args.disable_tta,
@@ -1056,19 +1826,21 @@ def predict_entry_point():
                                 device=device,
                                 verbose=args.verbose,
                                 verbose_preprocessing=args.verbose,
-                                allow_tqdm=not args.disable_progress_bar)
+                                allow_tqdm=not args.disable_progress_bar,
+                                precision=args.precision,
+                                tile_batch_size=args.tbs,
+                                max_views_per_forward=args.max_views_per_forward,
+                                max_src_batch=args.max_src_batch,
+                                fold_ensemble=args.fold_ensemble,
+                                keep_on_device=args.keep_on_device)
     predictor.initialize_from_trained_model_folder(
         model_folder,
         args.f,
         checkpoint_name=args.chk
     )
-    predictor.predict_from_files(args.i, args.o, save_probabilities=args.save_probabilities,
-                                 overwrite=not args.continue_prediction,
-                                 num_processes_preprocessing=args.npp,
-                                 num_processes_segmentation_export=args.nps,
-                                 folder_with_segs_from_prev_stage=args.prev_stage_predictions,
-                                 num_parts=args.num_parts,
-                                 part_id=args.part_id)
+    _predict_job(predictor, {k: getattr(args, k) for k in _PREDICTION_JOB_ARGS})
+    if args.server is not None:
+        _serve_prediction_jobs(predictor, args.server)
     # r = predict_from_raw_data(args.i,
     #                           args.o,
     #                           model_folder,
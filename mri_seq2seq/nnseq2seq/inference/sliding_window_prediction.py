@@ -1,21 +1,26 @@
-from functools import lru_cache
+from functools import lru_cache, reduce
 
 import numpy as np
 import torch
 from typing import Union, Tuple, List
 from acvl_utils.cropping_and_padding.padding import pad_nd_image
-from scipy.ndimage import gaussian_filter
+from scipy.ndimage import gaussian_filter1d
 
 
 @lru_cache(maxsize=2)
 def compute_gaussian(tile_size: Union[Tuple[int, ...], List[int]], sigma_scale: float = 1. / 8,
                      value_scaling_factor: float = 1, dtype=torch.float16, device=torch.device('cuda', 0)) \
         -> torch.Tensor:
-    tmp = np.zeros(tile_size)
     center_coords = [i // 2 for i in tile_size]
     sigmas = [i * sigma_scale for i in tile_size]
-    tmp[tuple(center_coords)] = 1
-    gaussian_importance_map = gaussian_filter(tmp, sigmas, 0, mode='constant', cval=0)
+    # gaussian_filter is separable and so is the centered delta it is applied to. Filtering a 1d delta per axis and
+    # taking their outer product gives the same map without running the filter over the whole tile
+    axis_maps = []
+    for size, center, sigma in zip(tile_size, center_coords, sigmas):
+        tmp = np.zeros(size)
+        tmp[center] = 1
+        axis_maps.append(gaussian_filter1d(tmp, sigma, order=0, mode='constant', cval=0))
+    gaussian_importance_map = reduce(np.multiply.outer, axis_maps)
 
     gaussian_importance_map = torch.from_numpy(gaussian_importance_map)
 
@@ -24,6 +24,7 @@ class ImageEncoder(nn.Module):
 
         self.down_layers = nn.ModuleList()
         self.up_layers = nn.ModuleList()
+        self.up_scales = []
         c_pre = self.c_in
         up_scale = 1
         up_channel = None
@@ -45,17 +46,13 @@ class ImageEncoder(nn.Module):
             self.down_layers.append(nn.Sequential(*block))
             c_pre = ce
 
-            if up_scale==1:
-                self.up_layers.append(nn.Sequential(
-                    nn.Conv2d(in_channels=ce, out_channels=up_channel, kernel_size=1, padding=0, stride=1),
-                    LayerNorm(up_channel, eps=1e-6, data_format="channels_first"),
-                ))
-            else:
-                self.up_layers.append(nn.Sequential(
-                    nn.Conv2d(in_channels=ce, out_channels=up_channel, kernel_size=1, padding=0, stride=1),
-                    LayerNorm(up_channel, eps=1e-6, data_format="channels_first"),
-                    nn.Upsample(scale_factor=up_scale, mode='nearest'),
-                ))
+            # the nearest neighbour upsampling back to the resolution of the first scale is done in forward
+            self.up_layers.append(nn.Sequential(
+                nn.Conv2d(in_channels=ce, out_channels=up_channel, kernel_size=1, padding=0, stride=1),
+                LayerNorm(up_channel, eps=1e-6, data_format="channels_first"),
+            ))
+            self.up_scales.append(up_scale)
+        self.up_channel = up_channel
         self.conv_latent = nn.Conv2d(in_channels=up_channel*len(self.c_enc), out_channels=self.latent_space_dim, kernel_size=1, padding=0, stride=1)
         self.quantize = VectorQuantizer(self.vq_n_embed, self.latent_space_dim, beta=self.vq_beta)
         self.p = nn.Conv2d(
@@ -64,12 +61,24 @@ class ImageEncoder(nn.Module):
             kernel_size=2, stride=2, padding=0)
 
     def forward(self, x):
-        features = []
-        for down, up in zip(self.down_layers, self.up_layers):
+        # conv_latent is a 1x1 conv over the concatenated scales, i.e. a sum of one 1x1 conv per scale. Those commute
+        # with the nearest neighbour upsampling, so every scale is projected to the latent space at its own resolution
+        # and only the projection is upsampled. Same result as upsampling and concatenating all features first, but
+        # without building the full resolution feature bank
+        z = None
+        for i, (down, up, up_scale) in enumerate(zip(self.down_layers, self.up_layers, self.up_scales)):
             x = down(x)
-            f = up(x)
-            features.append(f)
-        features = torch.cat(features, dim=1)
-        z = self.conv_latent(features)
+            # the bias of conv_latent is added once, by the projection of the first (full resolution) scale
+            f = F.conv2d(up(x), self.conv_latent.weight[:, i*self.up_channel:(i+1)*self.up_channel],
+                         self.conv_latent.bias if i == 0 else None)
+            if z is None:
+                # the scales are summed in fp32, under autocast the projections come in half precision
+                z = f.float()
+                continue
+            # nearest neighbour upsampling as a broadcast: view z as blocks of up_scale voxels per axis and add the
+            # coarse projection to every voxel of its block, without materializing the upsampled tensor
+            scales = up_scale if isinstance(up_scale, (tuple, list)) else [up_scale] * (f.ndim - 2)
+            z_blocks = z.view(*z.shape[:2], *[j for n, sc in zip(f.shape[2:], scales) for j in (n, sc)])
+            z_blocks.add_(f[(slice(None), slice(None)) + (slice(None), None) * (f.ndim - 2)])
         zq, vq_loss, _ = self.quantize(z)
         return zq, vq_loss
\ No newline at end of file
@@ -1,8 +1,11 @@
+from contextlib import nullcontext
+
 import numpy as np
 from einops import rearrange
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 
 
 class VectorQuantizer2(nn.Module):
@@ -67,33 +70,55 @@ class VectorQuantizer2(nn.Module):
         assert temp is None or temp==1.0, "Only for interface compatible with Gumbel"
         assert rescale_logits==False, "Only for interface compatible with Gumbel"
         assert return_logits==False, "Only for interface compatible with Gumbel"
-        # reshape z -> (batch, height, width, channel) and flatten
-        z = rearrange(z, 'b c h w -> b h w c').contiguous()
-        z_flattened = z.view(-1, self.e_dim)
-        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
-
-        d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
-            torch.sum(self.embedding.weight**2, dim=1) - 2 * \
-            torch.einsum('bd,dn->bn', z_flattened, rearrange(self.embedding.weight, 'n d -> d n'))
-
-        min_encoding_indices = torch.argmin(d, dim=1)
-        z_q = self.embedding(min_encoding_indices).view(z.shape)
-        perplexity = None
-        min_encodings = None
-
-        # compute loss for embedding
-        if not self.legacy:
-            loss = self.beta * torch.mean((z_q.detach()-z)**2) + \
-                   torch.mean((z_q - z.detach()) ** 2)
+        if torch.is_inference_mode_enabled():
+            # nothing is trained in inference mode: no loss and no straight-through gradients. The codes are scored
+            # with a 1x1 conv that has the codebook as kernel, so z is used in whatever memory format it comes in.
+            # argmin of z^2 + e^2 - 2 e * z is argmax of e * z - e^2 / 2, z^2 is the same for every code
+            channels_last = z.movedim(1, -1).is_contiguous()
+            # scored in fp32 even under autocast, half precision scores can pick a different one of two close codes
+            with torch.autocast('cuda', enabled=False) if torch.is_autocast_enabled() else nullcontext():
+                codebook = self.embedding.weight.float()
+                scores = F.conv2d(z.float(), codebook.view(self.n_e, self.e_dim, 1, 1),
+                                  -0.5 * torch.sum(codebook**2, dim=1))
+            min_encoding_indices = torch.argmax(scores, dim=1)
+            del scores
+            z_q = self.embedding(min_encoding_indices)
+            min_encoding_indices = min_encoding_indices.flatten()
+            perplexity = None
+            min_encodings = None
+            loss = None
+            # reshape back to match original input shape, in the memory format of the input
+            z_q = rearrange(z_q, 'b h w c -> b c h w')
+            if not channels_last:
+                z_q = z_q.contiguous()
         else:
-            loss = torch.mean((z_q.detach()-z)**2) + self.beta * \
-                   torch.mean((z_q - z.detach()) ** 2)
-
-        # preserve gradients
-        z_q = z + (z_q - z).detach()
+            # reshape z -> (batch, height, width, channel) and flatten
+            z = rearrange(z, 'b c h w -> b h w c').contiguous()
+            z_flattened = z.view(-1, self.e_dim)
+            # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
+
+            d = torch.sum(z_flattened ** 2, dim=1, keepdim=True) + \
+                torch.sum(self.embedding.weight**2, dim=1) - 2 * \
+                torch.einsum('bd,dn->bn', z_flattened, rearrange(self.embedding.weight, 'n d -> d n'))
+
+            min_encoding_indices = torch.argmin(d, dim=1)
+            z_q = self.embedding(min_encoding_indices).view(z.shape)
+            perplexity = None
+            min_encodings = None
+
+            # compute loss for embedding
+            if not self.legacy:
+                loss = self.beta * torch.mean((z_q.detach()-z)**2) + \
+                       torch.mean((z_q - z.detach()) ** 2)
+            else:
+                loss = torch.mean((z_q.detach()-z)**2) + self.beta * \
+                       torch.mean((z_q - z.detach()) ** 2)
+
+            # preserve gradients
+            z_q = z + (z_q - z).detach()
 
-        # reshape back to match original input shape
-        z_q = rearrange(z_q, 'b h w c -> b c h w').contiguous()
+            # reshape back to match original input shape
+            z_q = rearrange(z_q, 'b h w c -> b c h w').contiguous()
 
         if self.remap is not None:
             min_encoding_indices = min_encoding_indices.reshape(z.shape[0],-1) # add batch axis
@@ -43,5 +43,6 @@ class TSF_attention(nn.Module):
     def infer_contribution(self, s, eps=1e-5):
         seq_in = s[:, :self.num_channel].unsqueeze(-1).unsqueeze(-1).unsqueeze(-1)
         param = self.fc_w(s).unsqueeze(-1).unsqueeze(-1).unsqueeze(-1) + eps  # + eps to avoid dividing 0
-        w = (seq_in * param) / torch.sum(seq_in * param)
+        # normalize per code so that several codes can be evaluated in one batch
+        w = (seq_in * param) / torch.sum(seq_in * param, dim=1, keepdim=True)
         return w
\ No newline at end of file
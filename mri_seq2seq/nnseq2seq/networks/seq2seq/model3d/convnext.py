@@ -102,6 +102,11 @@ class LayerNorm(nn.Module):
         if self.data_format == "channels_last":
             return F.layer_norm(x, self.normalized_shape, self.weight, self.bias, self.eps)
         elif self.data_format == "channels_first":
+            x_last = x.movedim(1, -1)
+            if x_last.is_contiguous():
+                # channels last memory format: the channels are already the innermost axis, so the fused layer_norm
+                # kernel runs on a free view instead of the elementwise chain below
+                return F.layer_norm(x_last, self.normalized_shape, self.weight, self.bias, self.eps).movedim(-1, 1)
             u = x.mean(1, keepdim=True)
             s = (x - u).pow(2).mean(1, keepdim=True)
             x = (x - u) / torch.sqrt(s + self.eps)
@@ -292,6 +297,10 @@ class CrossAttnBlock(nn.Module):
 
         # compute attention
         b,c,d,w,h = q.shape
+        if k.shape[0] != b:
+            # a single style is shared by the whole batch
+            k = k.expand(b, -1, -1)
+            v = v.expand(b, -1, -1)
         sn = k.shape[-1]
         q = q.reshape(b*self.heads,self.dim_heads,d*w*h)
         q = q.permute(0,2,1)   # b,hw,c
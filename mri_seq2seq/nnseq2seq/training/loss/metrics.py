@@ -13,8 +13,12 @@ __all__ = [
 ]
 
 
-def torch_PSNR(image_true, image_test, data_range=255., eps=1e-9):
-    mse = torch.mean((image_true - image_test) ** 2) + eps
+def torch_PSNR(image_true, image_test, data_range=255., eps=1e-9, reduction='mean'):
+    # reduction='none' returns one PSNR per sample along the first dimension
+    if reduction == 'none':
+        mse = torch.mean((image_true - image_test).flatten(1) ** 2, dim=1) + eps
+    else:
+        mse = torch.mean((image_true - image_test) ** 2) + eps
     return 10 * torch.log10(data_range**2 / mse)
 
 
@@ -0,0 +1,73 @@
+import pytest
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+from nnseq2seq.networks.seq2seq.model2d.encoder import ImageEncoder as ImageEncoder2d
+from nnseq2seq.networks.seq2seq.model3d.encoder import ImageEncoder as ImageEncoder3d
+
+
+def _encoder_args():
+    return {
+        'in_channels': 1,
+        'conv_channels': [8, 16, 32],
+        'conv_kernel': [4, 2, 2],
+        'conv_stride': [4, 2, 2],
+        'resblock_n': [1, 2, 1],
+        'resblock_kernel': [3, 3, 3],
+        'resblock_padding': [1, 1, 1],
+        'layer_scale_init_value': 0.1,
+        'latent_space_dim': 3,
+        'vq_n_embed': 16,
+        'vq_beta': 0.25,
+    }
+
+
+class _NoQuantize(nn.Module):
+    # lets the encoder return the latent before quantization
+    def forward(self, z):
+        return z, None, None
+
+
+def _reference_latent(encoder, x):
+    # the original formulation: upsample every scale to full resolution, concatenate and project with conv_latent
+    features = []
+    for down, up, up_scale in zip(encoder.down_layers, encoder.up_layers, encoder.up_scales):
+        x = down(x)
+        features.append(F.interpolate(up(x), scale_factor=up_scale, mode='nearest'))
+    return encoder.conv_latent(torch.cat(features, dim=1))
+
+
+@pytest.mark.parametrize('encoder_class,shape', [(ImageEncoder2d, (2, 1, 32, 48)), (ImageEncoder3d, (2, 1, 32, 32, 48))])
+@pytest.mark.parametrize('channels_last', [False, True])
+def test_encoder_latent_matches_upsample_concat(encoder_class, shape, channels_last):
+    torch.manual_seed(0)
+    encoder = encoder_class(_encoder_args()).eval()
+    encoder.quantize = _NoQuantize()
+    x = torch.randn(shape)
+    if channels_last:
+        x = x.to(memory_format=torch.channels_last if x.ndim == 4 else torch.channels_last_3d)
+
+    with torch.no_grad():
+        expected = _reference_latent(encoder, x)
+        z, _ = encoder(x)
+
+    assert z.shape == expected.shape
+    torch.testing.assert_close(z, expected, rtol=1e-4, atol=1e-5)
+
+
+@pytest.mark.parametrize('encoder_class,shape', [(ImageEncoder2d, (2, 1, 32, 48)), (ImageEncoder3d, (2, 1, 32, 32, 48))])
+def test_encoder_latent_is_summed_in_fp32_under_autocast(encoder_class, shape):
+    torch.manual_seed(0)
+    encoder = encoder_class(_encoder_args()).eval()
+    encoder.quantize = _NoQuantize()
+    x = torch.randn(shape)
+
+    with torch.no_grad():
+        expected = _reference_latent(encoder, x)
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            z, _ = encoder(x)
+
+    # the projections come in bf16, their sum does not
+    assert z.dtype == torch.float32
+    torch.testing.assert_close(z, expected, rtol=5e-2, atol=5e-2)
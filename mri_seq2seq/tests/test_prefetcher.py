@@ -0,0 +1,52 @@
+import os
+
+import numpy as np
+import pytest
+
+from nnseq2seq.inference.predict_from_raw_data import _Prefetcher
+
+
+def _cases(n):
+    for i in range(n):
+        yield {'data': np.full((1, 4, 4), i, dtype=np.float32), 'ofile': None, 'data_properties': {}}
+
+
+def test_prefetcher_stops_when_the_prediction_loop_raises():
+    with pytest.raises(RuntimeError):
+        with _Prefetcher(_cases(10), max_prefetch=2) as prefetcher:
+            for item in prefetcher:
+                assert item['data'][0, 0, 0] == 0
+                raise RuntimeError('prediction failed')
+
+    assert not prefetcher.thread.is_alive()
+    assert prefetcher.queue.empty()
+
+
+def _npy_cases(folder, n):
+    for i in range(n):
+        fname = os.path.join(folder, f'case_{i}.npy')
+        np.save(fname, np.full((1, 4, 4), i, dtype=np.float32))
+        yield {'data': fname, 'ofile': None, 'data_properties': {}}
+
+
+def test_prefetcher_removes_the_mapped_files_when_the_prediction_loop_raises(tmp_path):
+    with pytest.raises(RuntimeError):
+        with _Prefetcher(_npy_cases(str(tmp_path), 10), max_prefetch=2) as prefetcher:
+            for item in prefetcher:
+                assert item['data'][0, 0, 0] == 0
+                raise RuntimeError('prediction failed')
+
+    # neither the failed case nor the ones that were prefetched behind it leave their file behind
+    assert os.listdir(tmp_path) == []
+
+
+def test_prefetcher_removes_each_file_once_its_case_is_done(tmp_path):
+    seen = []
+    with _Prefetcher(_npy_cases(str(tmp_path), 3)) as prefetcher:
+        for item in prefetcher:
+            seen.append(int(item['data'][0, 0, 0]))
+            # the current case is still mapped
+            assert os.path.isfile(item['delfile'])
+
+    assert seen == [0, 1, 2]
+    assert os.listdir(tmp_path) == []
@@ -0,0 +1,29 @@
+import pytest
+import torch
+
+from nnseq2seq.networks.seq2seq.model2d.quantize import VectorQuantizer2 as VectorQuantizer2d
+from nnseq2seq.networks.seq2seq.model3d.quantize import VectorQuantizer2 as VectorQuantizer3d
+
+
+@pytest.mark.parametrize('quantizer_class,shape', [(VectorQuantizer2d, (2, 3, 16, 24)),
+                                                   (VectorQuantizer3d, (2, 3, 8, 16, 12))])
+@pytest.mark.parametrize('channels_last', [False, True])
+def test_inference_lookup_matches_argmin(quantizer_class, shape, channels_last):
+    torch.manual_seed(0)
+    quantizer = quantizer_class(64, shape[1], beta=0.25)
+    quantizer.embedding.weight.data.normal_()
+    z = torch.randn(shape)
+    if channels_last:
+        z = z.to(memory_format=torch.channels_last if z.ndim == 4 else torch.channels_last_3d)
+
+    # outside of inference mode the quantizer takes the original (training) path: pairwise distances and argmin
+    with torch.no_grad():
+        expected, _, (_, _, expected_indices) = quantizer(z)
+    with torch.inference_mode():
+        z_q, loss, (_, _, indices) = quantizer(z)
+
+    assert loss is None
+    assert torch.equal(indices, expected_indices)
+    torch.testing.assert_close(z_q, expected, rtol=1e-6, atol=1e-6)
+    # the result comes in the memory format of the input
+    assert z_q.movedim(1, -1).is_contiguous() == channels_last
@@ -0,0 +1,94 @@
+import numpy as np
+import pytest
+import torch
+from scipy.ndimage import gaussian_filter
+
+from nnseq2seq.inference.sliding_window_prediction import compute_gaussian
+
+
+def _reference_gaussian(tile_size, sigma_scale, value_scaling_factor):
+    # the original formulation: an nd gaussian filter over a centered delta
+    tmp = np.zeros(tile_size)
+    tmp[tuple(i // 2 for i in tile_size)] = 1
+    gaussian_importance_map = gaussian_filter(tmp, [i * sigma_scale for i in tile_size], 0, mode='constant', cval=0)
+    gaussian_importance_map = torch.from_numpy(gaussian_importance_map)
+    gaussian_importance_map = gaussian_importance_map / torch.max(gaussian_importance_map) * value_scaling_factor
+    gaussian_importance_map = gaussian_importance_map.type(torch.float32)
+    gaussian_importance_map[gaussian_importance_map == 0] = torch.min(
+        gaussian_importance_map[gaussian_importance_map != 0])
+    return gaussian_importance_map
+
+
+@pytest.mark.parametrize('tile_size', [(64, 48), (7, 10), (32, 24, 40), (5, 16, 9)])
+@pytest.mark.parametrize('sigma_scale', [1. / 8, 1. / 4])
+def test_compute_gaussian_matches_nd_filter(tile_size, sigma_scale):
+    gaussian = compute_gaussian(tile_size, sigma_scale=sigma_scale, value_scaling_factor=10, dtype=torch.float32,
+                                device=torch.device('cpu'))
+    expected = _reference_gaussian(tile_size, sigma_scale, 10)
+
+    assert gaussian.shape == expected.shape
+    torch.testing.assert_close(gaussian, expected, rtol=1e-5, atol=1e-6)
+    assert torch.all(gaussian > 0)
+
+
+def test_sliding_window_halves_mirrored_views_on_out_of_memory():
+    from types import SimpleNamespace
+
+    from nnseq2seq.inference.predict_from_raw_data import nnSeq2SeqPredictor
+
+    predictor = nnSeq2SeqPredictor(device=torch.device('cpu'), precision='fp32', allow_tqdm=False,
+                                   max_views_per_forward=4)
+    # only settable on cuda devices, but the retry loop does not care where the prediction runs
+    predictor.perform_everything_on_device = True
+    predictor.allowed_mirroring_axes = (0, 1, 2)
+    predictor.configuration_manager = SimpleNamespace(patch_size=[8, 8, 8])
+    predictor.label_manager = SimpleNamespace(num_segmentation_heads=2)
+    predictor.list_of_parameters = [None]
+    predictor.network = torch.nn.Module()
+    predictor.network.image_encoder = SimpleNamespace(latent_space_dim=3)
+
+    calls = []
+
+    def mirror_and_predict(x, target_code, properties=None, with_attn=True, tsf_codes=None,
+                           max_views_per_forward=None):
+        calls.append(max_views_per_forward)
+        if max_views_per_forward > 1:
+            # the first tile is where a pass with too many views runs out of memory
+            raise torch.cuda.OutOfMemoryError('simulated out of memory')
+        return (torch.ones((x.shape[0], 1, 8, 8, 8)), torch.ones((x.shape[0], 2, 8, 8, 8)),
+                torch.ones((x.shape[0], 3, 2, 2, 2)))
+
+    predictor._internal_maybe_mirror_and_predict = mirror_and_predict
+    logits, mask_logits, latent_space = predictor.predict_sliding_window_return_logits(
+        torch.zeros((1, 8, 8, 8)), torch.zeros((1, 4)))
+
+    assert calls == [4, 2, 1]
+    torch.testing.assert_close(logits, torch.ones((1, 8, 8, 8)))
+    assert mask_logits.shape == (2, 8, 8, 8)
+    assert latent_space.shape == (3, 8, 8, 8)
+    # the next image starts from the configured number of views again
+    assert predictor.max_views_per_forward == 4
+
+
+def test_manual_initialization_keeps_the_memory_format_of_the_network():
+    from types import SimpleNamespace
+
+    from nnseq2seq.inference.predict_from_raw_data import nnSeq2SeqPredictor
+
+    predictor = nnSeq2SeqPredictor(device=torch.device('cpu'), allow_tqdm=False)
+    # only enabled on cuda devices, set here to check that an externally owned network is not converted anyway
+    predictor.channels_last = True
+    network = torch.nn.Module()
+    network.image_encoder = torch.nn.Conv3d(2, 4, 3)
+    plans_manager = SimpleNamespace(get_label_manager=lambda dataset_json: None)
+    predictor.manual_initialization(network, plans_manager, SimpleNamespace(patch_size=[8, 8, 8]), None, {},
+                                    'nnSeq2SeqTrainer', (0, 1, 2))
+
+    # predicting does not convert it either
+    predictor._internal_predict_sliding_window_return_logits = \
+        lambda data, *args, **kwargs: (torch.zeros_like(data), torch.zeros_like(data), None)
+    predictor.predict_sliding_window_return_logits(torch.zeros((1, 8, 8, 8)), torch.zeros((1, 4)), return_latent=False)
+
+    assert predictor.network is network
+    assert network.image_encoder.weight.is_contiguous()
+    assert not predictor._encoder_channels_last